@@ -0,0 +1,409 @@
+import re
+import time
+import random
+import threading
+
+from types import SimpleNamespace
+
+import httplib2
+
+from googleapiclient.errors import HttpError
+
+
+# Default latency (in seconds) of a request to each API
+LATENCY = {"gmail": 0.04, "sheets": 0.08, "palm": 0.3}
+
+
+def http_error(status: int, reason: str) -> HttpError:
+    return HttpError(httplib2.Response({"status": status}), reason.encode("utf-8"))
+
+
+class Calls:
+    def __init__(self):
+        """
+        Initializes the Calls class that counts the requests received by
+        the local services
+
+        ARGS:
+            None
+
+        RETURNS:
+            None
+        """
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(sorted(self.counts.items()))
+
+
+class Latency:
+    def __init__(self, seconds: float, jitter: float = 0.2, seed: int = 0):
+        """
+        Initializes the Latency class that simulates the round trip of a
+        request
+
+        ARGS:
+            seconds: Mean latency of a request
+            jitter: Fraction of the latency it is randomly moved by
+            seed: Seed of the random jitter
+
+        RETURNS:
+            None
+        """
+        self.seconds = seconds
+        self.jitter = jitter
+        self._rand = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        if self.seconds <= 0:
+            return
+        with self._lock:
+            delay = self.seconds * (1 + self._rand.uniform(-self.jitter, self.jitter))
+        time.sleep(delay)
+
+
+class FakeRequest:
+    def __init__(self, name: str, func, calls: Calls, latency: Latency):
+        """
+        Initializes the FakeRequest class, a stand-in for HttpRequest
+
+        ARGS:
+            name: Name of the method, as counted
+            func: Function returning the response
+            calls: Counter of the requests
+            latency: Latency of the request
+
+        RETURNS:
+            None
+        """
+        self.name = name
+        self.func = func
+        self.calls = calls
+        self.latency = latency
+
+    def execute(self, http=None, num_retries: int = 0):
+        self.calls.incr(self.name)
+        self.latency.wait()
+        return self.func()
+
+
+class FakeBatch:
+    def __init__(self, callback, calls: Calls, latency: Latency):
+        """
+        Initializes the FakeBatch class, a stand-in for BatchHttpRequest
+
+        ARGS:
+            callback: Function called with the response of each request
+            calls: Counter of the requests
+            latency: Latency of the whole batch
+
+        RETURNS:
+            None
+        """
+        self.callback = callback
+        self.calls = calls
+        self.latency = latency
+        self.requests = []
+
+    def add(self, request: FakeRequest, callback=None, request_id: str = None) -> None:
+        if len(self.requests) >= 1000:
+            raise ValueError("Exceeded the maximum of 1000 calls in a single batch")
+        self.requests.append((request_id or str(len(self.requests)), request))
+
+    def execute(self, http=None) -> None:
+        # One round trip for all the requests of the batch
+        self.calls.incr("gmail.batch")
+        self.latency.wait()
+
+        for request_id, request in self.requests:
+            self.calls.incr(request.name)
+            try:
+                response, exception = request.func(), None
+            except HttpError as error:
+                response, exception = None, error
+            self.callback(request_id, response, exception)
+
+
+class FakeGmail:
+    def __init__(self, fixtures, calls: Calls, latency: Latency):
+        """
+        Initializes the FakeGmail class, a stand-in for the Gmail service
+        serving the emails of the fixtures
+
+        ARGS:
+            fixtures: Fixtures of the benchmark
+            calls: Counter of the requests
+            latency: Latency of a request
+
+        RETURNS:
+            None
+        """
+        self.fixtures = fixtures
+        self.calls = calls
+        self.latency = latency
+        self.history_id = str(9000000 + len(fixtures.ids))
+        self._lock = threading.Lock()
+
+    def request(self, name: str, func) -> FakeRequest:
+        return FakeRequest(f"gmail.{name}", func, self.calls, self.latency)
+
+    def new_batch_http_request(self, callback=None) -> FakeBatch:
+        return FakeBatch(callback, self.calls, self.latency)
+
+    # users()
+    def users(self):
+        return self
+
+    def getProfile(self, userId: str) -> FakeRequest:
+        return self.request(
+            "users.getProfile",
+            lambda: {
+                "emailAddress": self.fixtures.receiver,
+                "messagesTotal": len(self.fixtures.ids),
+                "historyId": self.history_id,
+            },
+        )
+
+    def watch(self, userId: str, body: dict) -> FakeRequest:
+        return self.request(
+            "users.watch",
+            lambda: {"historyId": self.history_id, "expiration": str(int(time.time() * 1000))},
+        )
+
+    def history(self):
+        return SimpleNamespace(list=self.list_history)
+
+    def messages(self):
+        return SimpleNamespace(
+            list=self.list_messages,
+            get=self.get_message,
+            modify=self.modify_message,
+            batchModify=self.batch_modify_messages,
+        )
+
+    # users().history()
+    def list_history(self, userId: str, startHistoryId: str, **kwargs) -> FakeRequest:
+        return self.request(
+            "history.list", lambda: {"history": [], "historyId": self.history_id}
+        )
+
+    # users().messages()
+    def list_messages(
+        self, userId: str, q: str = None, maxResults: int = 100, pageToken: str = None, **kwargs
+    ) -> FakeRequest:
+        def respond():
+            start = int(pageToken or 0)
+            ids = self.fixtures.ids[start : start + maxResults]
+            result = {
+                "messages": [{"id": msg_id, "threadId": msg_id} for msg_id in ids],
+                "resultSizeEstimate": len(ids),
+            }
+            if start + maxResults < len(self.fixtures.ids):
+                result["nextPageToken"] = str(start + maxResults)
+            return result
+
+        return self.request("messages.list", respond)
+
+    def get_message(
+        self, userId: str, id: str, format: str = "full", metadataHeaders: list = None, **kwargs
+    ) -> FakeRequest:
+        def respond():
+            message = self.fixtures.messages.get(id)
+            if message is None:
+                raise http_error(404, "Requested entity was not found.")
+            if format != "metadata":
+                return message
+
+            headers = [
+                header
+                for header in message["payload"]["headers"]
+                if not metadataHeaders or header["name"] in metadataHeaders
+            ]
+            result = {key: value for key, value in message.items() if key != "payload"}
+            result["payload"] = {"headers": headers}
+            return result
+
+        return self.request("messages.get", respond)
+
+    def modify_message(self, userId: str, id: str, body: dict) -> FakeRequest:
+        def respond():
+            self.relabel([id], body)
+            return {"id": id, "labelIds": self.fixtures.messages[id]["labelIds"]}
+
+        return self.request("messages.modify", respond)
+
+    def batch_modify_messages(self, userId: str, body: dict) -> FakeRequest:
+        def respond():
+            if len(body["ids"]) > 1000:
+                raise http_error(400, "Too many ids, the maximum is 1000.")
+            self.relabel(body["ids"], body)
+            return ""
+
+        return self.request("messages.batchModify", respond)
+
+    def relabel(self, ids: list, body: dict) -> None:
+        with self._lock:
+            for msg_id in ids:
+                message = self.fixtures.messages.get(msg_id)
+                if message is None:
+                    raise http_error(404, "Requested entity was not found.")
+                labels = [
+                    label
+                    for label in message["labelIds"]
+                    if label not in body.get("removeLabelIds", [])
+                ]
+                labels += [
+                    label for label in body.get("addLabelIds", []) if label not in labels
+                ]
+                message["labelIds"] = labels
+
+
+class FakeSheets:
+    def __init__(self, fixtures, calls: Calls, latency: Latency):
+        """
+        Initializes the FakeSheets class, a stand-in for the Sheets service
+        keeping the sheet of the fixtures in memory
+
+        ARGS:
+            fixtures: Fixtures of the benchmark
+            calls: Counter of the requests
+            latency: Latency of a request
+
+        RETURNS:
+            None
+        """
+        self.calls = calls
+        self.latency = latency
+        self.rows = {i + 1: list(row) for i, row in enumerate(fixtures.sheet)}
+        self._lock = threading.Lock()
+
+    def request(self, name: str, func) -> FakeRequest:
+        return FakeRequest(f"sheets.{name}", func, self.calls, self.latency)
+
+    @staticmethod
+    def parse_range(range_name: str) -> tuple:
+        """
+        Returns the first and last rows and columns of an A1 range
+
+        ARGS:
+            range_name: The range (e.g. A2:F2 or A2:B)
+
+        RETURNS:
+            First row, last row (None for an open range), first column and
+            last column (starting at 0)
+        """
+        match = re.fullmatch(r"(?:[^!]*!)?([A-Z]+)(\d+)(?::([A-Z]+)(\d*))?", range_name)
+        if match is None:
+            raise http_error(400, f"Unable to parse range: {range_name}")
+
+        def column(letters: str) -> int:
+            index = 0
+            for letter in letters:
+                index = index * 26 + ord(letter) - ord("A") + 1
+            return index - 1
+
+        first_col, first_row, last_col, last_row = match.groups()
+        if last_col is None:
+            return int(first_row), int(first_row), column(first_col), column(first_col)
+        return (
+            int(first_row),
+            int(last_row) if last_row else None,
+            column(first_col),
+            column(last_col),
+        )
+
+    def read(self, range_name: str) -> dict:
+        first_row, last_row, first_col, last_col = self.parse_range(range_name)
+        with self._lock:
+            if last_row is None:
+                last_row = max(self.rows, default=0)
+            values = [
+                self.rows.get(row, [])[first_col : last_col + 1]
+                for row in range(first_row, last_row + 1)
+            ]
+
+        # Trailing empty rows are not returned
+        while values and not values[-1]:
+            values.pop()
+
+        result = {"range": range_name, "majorDimension": "ROWS"}
+        if values:
+            result["values"] = values
+        return result
+
+    def write(self, range_name: str, values: list) -> dict:
+        first_row, _, first_col, _ = self.parse_range(range_name)
+        with self._lock:
+            for i, value in enumerate(values):
+                row = self.rows.setdefault(first_row + i, [])
+                end = first_col + len(value)
+                row.extend([""] * (end - len(row)))
+                row[first_col:end] = value
+        return {"updatedRange": range_name, "updatedRows": len(values)}
+
+    # spreadsheets()
+    def spreadsheets(self):
+        return self
+
+    def create(self, body: dict, fields: str = None) -> FakeRequest:
+        return self.request("create", lambda: {"spreadsheetId": "benchmark-sheet"})
+
+    def values(self):
+        return SimpleNamespace(
+            get=self.get_values, update=self.update_values, batchUpdate=self.batch_update_values
+        )
+
+    # spreadsheets().values()
+    def get_values(self, spreadsheetId: str, range: str, **kwargs) -> FakeRequest:
+        return self.request("values.get", lambda: self.read(range))
+
+    def update_values(
+        self, spreadsheetId: str, range: str, valueInputOption: str, body: dict
+    ) -> FakeRequest:
+        return self.request("values.update", lambda: self.write(range, body["values"]))
+
+    def batch_update_values(self, spreadsheetId: str, body: dict) -> FakeRequest:
+        def respond():
+            responses = [self.write(data["range"], data["values"]) for data in body["data"]]
+            return {"spreadsheetId": spreadsheetId, "responses": responses}
+
+        return self.request("values.batchUpdate", respond)
+
+
+class FakePalm:
+    def __init__(self, fixtures, calls: Calls, latency: Latency):
+        """
+        Initializes the FakePalm class, a stand-in for google.generativeai
+        answering with the recorded responses of the fixtures
+
+        ARGS:
+            fixtures: Fixtures of the benchmark
+            calls: Counter of the requests
+            latency: Latency of a request
+
+        RETURNS:
+            None
+        """
+        self.fixtures = fixtures
+        self.calls = calls
+        self.latency = latency
+
+    def list_models(self):
+        self.calls.incr("palm.list_models")
+        self.latency.wait()
+        yield SimpleNamespace(
+            name="models/text-bison-001",
+            supported_generation_methods=["generateText", "countMessageTokens"],
+        )
+
+    def generate_text(self, model: str, prompt: str, **kwargs):
+        self.calls.incr("palm.generate_text")
+        self.latency.wait()
+        return SimpleNamespace(result=self.fixtures.response(prompt))
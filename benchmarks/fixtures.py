@@ -0,0 +1,245 @@
+import re
+import json
+import html
+import base64
+import random
+import os.path
+import datetime
+import email.utils
+
+
+# Recorded templates of the emails, the sheet and the model responses
+FIXTURES_FILE = os.path.join(os.path.dirname(__file__), "fixtures.json")
+
+# Date of the most recent email, so that every run sees the same mailbox
+NEWEST = datetime.datetime(2024, 3, 1, 18, 0, tzinfo=datetime.timezone.utc)
+
+# Minutes between two consecutive emails
+SPACING = 17
+
+# Reference numbers written in the emails, used to find their model response
+FIRST_REF = 100000
+REF_PATTERN = re.compile(r"#(\d{6})\b")
+
+# Outer markup of the html emails, as sent by the usual mailing services
+HTML_PAGE = """<!DOCTYPE html><html><head><meta http-equiv="Content-Type" content="text/html; charset=UTF-8">
+<style type="text/css">body{{margin:0;padding:0;font-family:Helvetica,Arial,sans-serif}}
+table{{border-collapse:collapse}}.footer{{color:#8a8a8a;font-size:11px}}</style></head>
+<body><table width="100%" cellpadding="0" cellspacing="0" role="presentation"><tr><td align="center">
+<table width="600" cellpadding="0" cellspacing="0" role="presentation"><tr><td style="padding:24px">
+{body}
+</td></tr></table></td></tr></table>
+<img src="https://links.example.com/open/{ref}.gif" width="1" height="1" alt=""></body></html>"""
+
+
+def slug(name: str) -> str:
+    return re.sub(r"[^a-z0-9]", "", name.lower())
+
+
+def encode(text: str) -> str:
+    # Gmail returns the bodies in url safe base64
+    return base64.urlsafe_b64encode(text.encode("utf-8")).decode("ascii")
+
+
+def to_html(text: str, ref: int) -> str:
+    paragraphs = "\n".join(
+        f'<p style="margin:0 0 16px 0;line-height:1.5">{html.escape(p).replace(chr(10), "<br>")}</p>'
+        for p in text.split("\n\n")
+    )
+    return HTML_PAGE.format(body=paragraphs, ref=ref)
+
+
+class Fixtures:
+    def __init__(self, size: int, seed: int = 0, sheet_rows: int = 200):
+        """
+        Initializes the Fixtures class, the mailbox, the sheet and the model
+        responses replayed by a benchmark run, expanded from the recorded
+        templates of FIXTURES_FILE
+
+        ARGS:
+            size: Number of emails in the mailbox
+            seed: Seed of the random choices, the same seed gives the same
+                  fixtures
+            sheet_rows: Number of applications already in the sheet
+
+        RETURNS:
+            None
+        """
+        with open(FIXTURES_FILE, "r") as file:
+            recorded = json.load(file)
+
+        rand = random.Random(seed)
+        self.receiver = recorded["receiver"]
+        self.companies = recorded["companies"]
+        self.roles = recorded["roles"]
+
+        # Emails by id, newest first as Gmail lists them
+        self.ids = []
+        self.messages = {}
+
+        # Model response fields of each email, by reference number
+        self.responses = {}
+
+        templates = recorded["templates"]
+        weights = [template["weight"] for template in templates]
+
+        for i in range(size):
+            template = rand.choices(templates, weights)[0]
+            company = rand.choice(self.companies)
+            role = rand.choice(self.roles)
+            ref = FIRST_REF + i
+            date = NEWEST - datetime.timedelta(minutes=SPACING * i)
+
+            values = {
+                "company": company,
+                "company_domain": slug(company) + ".com",
+                "role": role,
+                "ref": ref,
+                "ats": rand.choice(recorded["ats_domains"]),
+            }
+            msg_id = f"{0x18d0a0000000 + i * 7919:x}"
+
+            self.ids.append(msg_id)
+            self.messages[msg_id] = self.message(msg_id, template, values, date)
+
+            response = {"company": company, "role": role}
+            response.update(template["response"])
+            response["wrap"] = template["wrap"]
+            self.responses[ref] = response
+
+        # Applications already in the sheet, older than the emails
+        self.sheet = [["Company", "Role", "Date", "Notes", "Most Recent Email", "Status"]]
+        for i in range(sheet_rows):
+            date = NEWEST - datetime.timedelta(days=60, minutes=SPACING * i)
+            self.sheet.append(
+                [
+                    self.companies[i % len(self.companies)],
+                    self.roles[(i * 7) % len(self.roles)],
+                    email.utils.format_datetime(date),
+                    "",
+                    f"https://mail.google.com/mail/u/0/#inbox/{i:x}",
+                    "APPLICATION",
+                ]
+            )
+
+    def message(self, msg_id: str, template: dict, values: dict, date) -> dict:
+        """
+        Returns the email in the full format of the Gmail API
+
+        ARGS:
+            msg_id: Id of the email
+            template: Recorded template of the email
+            values: Values of the placeholders of the template
+            date: Date of the email
+
+        RETURNS:
+            The email
+        """
+        text = template["text"].format(**values)
+        sender = template["sender"].format(**values)
+        subject = template["subject"].format(**values)
+
+        headers = [
+            {"name": "Delivered-To", "value": email.utils.parseaddr(self.receiver)[1]},
+            {"name": "Received", "value": f"by 2002:a05:6a10:{values['ref'] % 9999:x} with SMTP id {msg_id}; {email.utils.format_datetime(date)}"},
+            {"name": "MIME-Version", "value": "1.0"},
+            {"name": "Date", "value": email.utils.format_datetime(date)},
+            {"name": "Message-ID", "value": f"<{msg_id}.{values['ref']}@{values['company_domain']}>"},
+            {"name": "Subject", "value": subject},
+            {"name": "From", "value": sender},
+            {"name": "To", "value": self.receiver},
+        ]
+
+        plain = {
+            "mimeType": "text/plain",
+            "filename": "",
+            "headers": [
+                {"name": "Content-Type", "value": 'text/plain; charset="UTF-8"'},
+                {"name": "Content-Transfer-Encoding", "value": "quoted-printable"},
+            ],
+            "body": {"size": len(text), "data": encode(text)},
+        }
+        markup = to_html(text, values["ref"])
+        rich = {
+            "mimeType": "text/html",
+            "filename": "",
+            "headers": [
+                {"name": "Content-Type", "value": 'text/html; charset="UTF-8"'},
+                {"name": "Content-Transfer-Encoding", "value": "quoted-printable"},
+            ],
+            "body": {"size": len(markup), "data": encode(markup)},
+        }
+
+        if template["format"] == "alternative":
+            plain["partId"] = "0"
+            rich["partId"] = "1"
+            payload = {
+                "partId": "",
+                "mimeType": "multipart/alternative",
+                "filename": "",
+                "headers": headers
+                + [{"name": "Content-Type", "value": f'multipart/alternative; boundary="{msg_id}"'}],
+                "body": {"size": 0},
+                "parts": [plain, rich],
+            }
+        else:
+            payload = dict(plain if template["format"] == "plain" else rich)
+            payload["partId"] = ""
+            payload["headers"] = headers + payload["headers"]
+
+        return {
+            "id": msg_id,
+            "threadId": msg_id,
+            "labelIds": ["UNREAD", "CATEGORY_UPDATES", "INBOX"],
+            "snippet": html.escape(" ".join(text.split())[:140]),
+            "historyId": str(5000000 + values["ref"]),
+            "internalDate": str(int(date.timestamp() * 1000)),
+            "sizeEstimate": len(text) + len(markup) + 2048,
+            "payload": payload,
+        }
+
+    def response(self, prompt: str) -> str:
+        """
+        Returns the recorded model response to the prompt
+
+        ARGS:
+            prompt: The prompt, with the email message in it
+
+        RETURNS:
+            The response
+        """
+        # Classification of many messages, one answer per message
+        if "<message number>: YES" in prompt:
+            sections = re.split(r"^\s*Message (\d+):$", prompt, flags=re.MULTILINE)
+            lines = []
+            for number, section in zip(sections[1::2], sections[2::2]):
+                match = REF_PATTERN.search(section)
+                fields = self.responses.get(int(match.group(1))) if match else None
+                if fields is not None:
+                    answer = "YES 0.95" if fields["is_application"] else "NO 0.9"
+                    lines.append(f"{number}: {answer}")
+            return "\n".join(lines)
+
+        match = REF_PATTERN.search(prompt)
+        fields = self.responses.get(int(match.group(1))) if match else None
+        if fields is None:
+            return "I'm sorry, I can't help with that."
+
+        if '"is_application"' in prompt:
+            answer = {
+                key: fields[key]
+                for key in ("is_application", "company", "role", "notes", "status")
+            }
+            result = json.dumps(answer, indent=4)
+            if fields["wrap"]:
+                result = f"```json\n{result}\n```"
+            return result
+
+        # The prompts of the single fields
+        if "name of the compnay" in prompt:
+            return fields["company"]
+        if "name of the role" in prompt:
+            return fields["role"]
+        if "status of the application" in prompt:
+            return fields["status"]
+        return fields["notes"]
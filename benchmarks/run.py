@@ -0,0 +1,333 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+
+# Runs the whole program on recorded fixtures with local stand-ins of the
+# Gmail, Sheets and PaLM APIs, so it can be tuned without the live services:
+#
+#     python -m benchmarks.run
+#     python -m benchmarks.run --sizes 100 --latency-scale 0 --no-prefilter
+#     python -m benchmarks.run --output after.json --compare before.json
+#
+# Unknown options are passed to main.py (e.g. --batch-size 50 --extract 16)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Number of emails of each run
+SIZES = [10, 100, 1000]
+
+
+def parse_args(argv: list = None) -> tuple:
+    """
+    Parses the command line arguments
+
+    ARGS:
+        argv: The arguments (defaults to the ones of the program)
+
+    RETURNS:
+        The arguments of the benchmark, and the ones passed to main.py
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the program with local stand-ins of the APIs"
+    )
+    parser.add_argument(
+        "--sizes",
+        nargs="+",
+        type=int,
+        default=SIZES,
+        help="Number of emails of each run (default: 10 100 1000)",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="Seed of the fixtures (default: 0)"
+    )
+    parser.add_argument(
+        "--sheet-rows",
+        type=int,
+        default=200,
+        help="Applications already in the sheet (default: 200)",
+    )
+    parser.add_argument(
+        "--latency-scale",
+        type=float,
+        default=1.0,
+        help="Multiplier of the simulated latency of the APIs, 0 to measure "
+        "only the program itself (default: 1)",
+    )
+    parser.add_argument(
+        "--jitter",
+        type=float,
+        default=0.2,
+        help="Fraction of the latency it is randomly moved by (default: 0.2)",
+    )
+    parser.add_argument(
+        "--quota",
+        action="store_true",
+        help="Keep the request rates of the real quotas (only the concurrency "
+        "limits are kept by default)",
+    )
+    parser.add_argument(
+        "--output",
+        default="benchmark_results.json",
+        metavar="PATH",
+        help="Where to write the results (default: benchmark_results.json)",
+    )
+    parser.add_argument(
+        "--compare",
+        metavar="PATH",
+        help="Results of a previous benchmark to compare with",
+    )
+    # Used by the benchmark to run one size in its own process
+    parser.add_argument("--single", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+
+    return parser.parse_known_args(argv)
+
+
+def run_single(args: argparse.Namespace, program_args: list) -> dict:
+    """
+    Processes the emails of the fixtures, in the current process and
+    directory
+
+    ARGS:
+        args: The arguments of the benchmark
+        program_args: The arguments passed to main.py
+
+    RETURNS:
+        The results of the run
+    """
+    import ratelimit
+
+    # Only the quotas are lifted, the program still limits its concurrency
+    if not args.quota:
+        for limits in ratelimit.LIMITS.values():
+            limits["rate"] = limits["burst"] = 1e9
+
+    import main
+    import nlp_service
+
+    from cache import ResponseCache
+    from ledger import Ledger
+    from metrics import metrics
+    from palm_utlis import Processor
+    from workers import GmailWorker, SheetsWorker
+
+    from benchmarks.fakes import LATENCY, Calls, FakeGmail, FakePalm, FakeSheets, Latency
+    from benchmarks.fixtures import Fixtures
+
+    main_args = main.parse_args(program_args)
+    fixtures = Fixtures(args.single, args.seed, args.sheet_rows)
+    calls = Calls()
+
+    def latency(api: str) -> Latency:
+        return Latency(LATENCY[api] * args.latency_scale, args.jitter, args.seed)
+
+    start = time.perf_counter()
+    sheets = FakeSheets(fixtures, calls, latency("sheets"))
+    gmail_worker = GmailWorker(FakeGmail(fixtures, calls, latency("gmail")))
+    sheets_worker = SheetsWorker(sheets)
+
+    # The sheet of the fixtures was created by a previous run
+    sheets_worker.state.set("sheet_id", "benchmark-sheet")
+    sheets_worker.state.set("sheet_name", "jobsheet")
+    sheets_worker.state.set("next_row", len(fixtures.sheet) + 1)
+    processor = Processor(
+        None,
+        None if main_args.no_cache else ResponseCache(),
+        FakePalm(fixtures, calls, latency("palm")),
+    )
+    pipeline = main.create_pipeline(
+        main_args, gmail_worker, Ledger(), sheets_worker, processor
+    )
+
+    # The model is loaded outside of the measured time
+    nlp_service.get_nlp()
+    setup = time.perf_counter() - start
+
+    start = time.perf_counter()
+    emails = gmail_worker.iter_new_messages(None, main.MAX_DAYS, "unread", "inbox")
+    app_categories = pipeline.run(emails)
+    elapsed = time.perf_counter() - start
+
+    api_calls = calls.snapshot()
+    return {
+        "emails": args.single,
+        "seconds": elapsed,
+        "emails_per_sec": args.single / elapsed if elapsed else None,
+        "setup_seconds": setup,
+        "api_calls": api_calls,
+        "api_calls_total": sum(
+            n for name, n in api_calls.items() if name != "gmail.batch"
+        ),
+        "peak_rss_mb": nlp_service.peak_rss(),
+        "updates": app_categories,
+        "sheet_rows": len(sheets.rows) - 1,
+        "latencies": metrics.summary(),
+        "counters": metrics.report()["counters"],
+    }
+
+
+def run(args: argparse.Namespace, program_args: list, size: int) -> dict:
+    """
+    Runs the benchmark of one size in its own process, so that the peak
+    memory of a run doesn't include the previous ones
+
+    ARGS:
+        args: The arguments of the benchmark
+        program_args: The arguments passed to main.py
+        size: Number of emails
+
+    RETURNS:
+        The results of the run
+    """
+    with tempfile.TemporaryDirectory(prefix="benchmark-") as directory:
+        result_file = os.path.join(directory, "result.json")
+        log_file = os.path.join(directory, "output.log")
+
+        command = [
+            sys.executable,
+            "-m",
+            "benchmarks.run",
+            "--single",
+            str(size),
+            "--result-file",
+            result_file,
+            "--seed",
+            str(args.seed),
+            "--sheet-rows",
+            str(args.sheet_rows),
+            "--latency-scale",
+            str(args.latency_scale),
+            "--jitter",
+            str(args.jitter),
+        ]
+        if args.quota:
+            command.append("--quota")
+
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(filter(None, [ROOT, env.get("PYTHONPATH")]))
+
+        # Every file of the program is written in the temporary directory
+        with open(log_file, "w") as log:
+            process = subprocess.run(
+                command + program_args,
+                cwd=directory,
+                env=env,
+                stdout=log,
+                stderr=subprocess.STDOUT,
+            )
+
+        if process.returncode != 0 or not os.path.exists(result_file):
+            with open(log_file, "r") as log:
+                print(log.read()[-4000:])
+            raise RuntimeError(f"The benchmark of {size} emails failed")
+
+        with open(result_file, "r") as file:
+            return json.load(file)
+
+
+def git_commit() -> str:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results: list, previous: dict = None) -> None:
+    """
+    Prints the results, and how they changed since the previous benchmark
+
+    ARGS:
+        results: The results of each run
+        previous: Results of a previous benchmark, if any
+
+    RETURNS:
+        None
+    """
+    before = {}
+    if previous:
+        before = {result["emails"]: result for result in previous["runs"]}
+        print(f"Compared with {previous.get('commit')} (before -> after)")
+
+    def change(old, new, fmt: str) -> str:
+        if old is None:
+            return format(new, fmt)
+        diff = (new - old) / old * 100 if old else 0.0
+        return f"{format(old, fmt)} -> {format(new, fmt)} ({diff:+.0f}%)"
+
+    print(f"{'emails':>7}  {'seconds':>24}  {'emails/s':>24}  {'api calls':>20}  {'peak MB':>24}")
+    for result in results:
+        old = before.get(result["emails"], {})
+        print(
+            f"{result['emails']:>7}  "
+            f"{change(old.get('seconds'), result['seconds'], '.2f'):>24}  "
+            f"{change(old.get('emails_per_sec'), result['emails_per_sec'], '.1f'):>24}  "
+            f"{change(old.get('api_calls_total'), result['api_calls_total'], 'd'):>20}  "
+            f"{change(old.get('peak_rss_mb'), result['peak_rss_mb'], '.0f'):>24}"
+        )
+
+
+def main():
+    args, program_args = parse_args()
+
+    if args.single:
+        result = run_single(args, program_args)
+        with open(args.result_file, "w") as file:
+            json.dump(result, file, indent=2)
+        return
+
+    previous = None
+    if args.compare:
+        with open(args.compare, "r") as file:
+            previous = json.load(file)
+
+    params = {
+        "seed": args.seed,
+        "sheet_rows": args.sheet_rows,
+        "latency_scale": args.latency_scale,
+        "jitter": args.jitter,
+        "quota": args.quota,
+        "program_args": program_args,
+    }
+    if previous and previous.get("params") != params:
+        print("Warning: the previous benchmark was run with other parameters")
+
+    results = []
+    for size in args.sizes:
+        print(f"Benchmarking {size} emails...")
+        results.append(run(args, program_args, size))
+
+    report = {
+        "commit": git_commit(),
+        "created": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": params,
+        "runs": results,
+    }
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+
+    print_results(results, previous)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+import time
+import hashlib
+import sqlite3
+import threading
+
+
+class ResponseCache:
+    def __init__(
+        self,
+        path: str = "llm_cache.sqlite3",
+        max_entries: int = 20000,
+        max_age: float = 30 * 24 * 60 * 60,
+    ):
+        """
+        Initializes the ResponseCache class, a persistent cache for the
+        responses of the model stored in a local SQLite file
+
+        ARGS:
+            path: Path of the SQLite file
+            max_entries: Maximum number of responses kept (least recently
+                         used ones are evicted first)
+            max_age: Maximum age of a response in seconds
+
+        RETURNS:
+            None
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._writes = 0
+
+        # Access times of the hits, written with the next write to the file
+        self._accessed = {}
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)"
+        )
+        self._conn.commit()
+        self.evict()
+
+    @staticmethod
+    def make_key(model: str, version: str, task: str, message: str) -> str:
+        """
+        Returns the key of a response
+
+        ARGS:
+            model: Name of the model
+            version: Version of the prompt template
+            task: Name of the prompt (company, role, status, ...)
+            message: The email message the prompt is about
+
+        RETURNS:
+            The key of the response
+        """
+        message_hash = hashlib.sha256(message.encode("utf-8")).hexdigest()
+        return hashlib.sha256(
+            "\0".join([model, version, task, message_hash]).encode("utf-8")
+        ).hexdigest()
+
+    def get(self, key: str) -> str:
+        """
+        Returns the cached response
+
+        ARGS:
+            key: The key of the response
+
+        RETURNS:
+            The response, or None if it isn't cached
+        """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM responses WHERE key = ? AND created >= ?",
+                (key, now - self.max_age),
+            ).fetchone()
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._accessed[key] = now
+            return row[0]
+
+    def set(self, key: str, value: str) -> None:
+        """
+        Caches the response
+
+        ARGS:
+            key: The key of the response
+            value: The response
+
+        RETURNS:
+            None
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                (key, value, now, now),
+            )
+            self._write_accessed()
+            self._conn.commit()
+            self._writes += 1
+
+        # Keep the size in check without counting the rows on every write
+        if self._writes % 100 == 0:
+            self.evict()
+
+    def evict(self) -> None:
+        """
+        Removes the responses that are too old or over the size limit
+
+        ARGS:
+            None
+
+        RETURNS:
+            None
+        """
+        with self._lock:
+            # The least recently used responses are found with the latest hits
+            self._write_accessed()
+            self._conn.execute(
+                "DELETE FROM responses WHERE created < ?",
+                (time.time() - self.max_age,),
+            )
+            self._conn.execute(
+                """
+                DELETE FROM responses WHERE key IN (
+                    SELECT key FROM responses ORDER BY accessed DESC
+                    LIMIT -1 OFFSET ?
+                )
+                """,
+                (self.max_entries,),
+            )
+            self._conn.commit()
+
+    def flush(self) -> None:
+        """
+        Writes the access times of the hits to the file
+
+        ARGS:
+            None
+
+        RETURNS:
+            None
+        """
+        with self._lock:
+            if self._accessed:
+                self._write_accessed()
+                self._conn.commit()
+
+    def _write_accessed(self) -> None:
+        # Called with the lock held, the caller commits
+        if self._accessed:
+            self._conn.executemany(
+                "UPDATE responses SET accessed = ? WHERE key = ?",
+                [(accessed, key) for key, accessed in self._accessed.items()],
+            )
+            self._accessed = {}
+
+    def close(self) -> None:
+        """
+        Closes the cache file
+
+        ARGS:
+            None
+
+        RETURNS:
+            None
+        """
+        self.flush()
+        with self._lock:
+            self._conn.close()
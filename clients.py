@@ -0,0 +1,155 @@
+import queue
+import threading
+
+from ratelimit import LIMITS
+
+
+# If modifying these scopes, delete the file token.json.
+SCOPES = [
+    "https://www.googleapis.com/auth/gmail.modify",
+    "https://www.googleapis.com/auth/gmail.readonly",
+    "https://www.googleapis.com/auth/spreadsheets",
+]
+
+# Seconds to wait for a response of the Google APIs
+TIMEOUT = 60
+
+_lock = threading.Lock()
+_manager = None
+_services = {}
+
+
+def get_credentials():
+    """
+    Returns the credentials of the user shared by the whole process, kept
+    fresh in the background by a CredentialManager
+
+    ARGS:
+        None
+
+    RETURNS:
+        google.oauth2.credentials.Credentials: The credentials
+    """
+    global _manager
+
+    with _lock:
+        if _manager is None:
+            # Imported here so that starting the program doesn't wait for it
+            from credential_manager import CredentialManager
+
+            _manager = CredentialManager("token.json", "credentials.json", SCOPES)
+
+    return _manager.get()
+
+
+class PooledHttp:
+    def __init__(self, credentials, size: int, timeout: float = TIMEOUT):
+        """
+        Initializes the PooledHttp class, a thread safe stand-in for
+        httplib2.Http that sends each request with one of a pool of
+        authorized transports, so that their connections are kept alive
+        and reused
+
+        ARGS:
+            credentials: Credentials shared by the transports
+            size: Maximum number of transports (concurrent requests)
+            timeout: Seconds to wait for a response
+
+        RETURNS:
+            None
+        """
+        self.credentials = credentials
+        self.size = size
+        self.timeout = timeout
+
+        # The most recently used transports are reused first, their
+        # connections are the most likely to still be open
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def new_transport(self):
+        import httplib2
+        import google_auth_httplib2
+
+        return google_auth_httplib2.AuthorizedHttp(
+            self.credentials, http=httplib2.Http(timeout=self.timeout)
+        )
+
+    def request(self, *args, **kwargs):
+        """
+        Sends the request with an idle transport
+
+        ARGS:
+            args: Arguments of httplib2.Http.request
+            kwargs: Keyword arguments of httplib2.Http.request
+
+        RETURNS:
+            The response and its content
+        """
+        with self._slots:
+            try:
+                transport = self._idle.get_nowait()
+            except queue.Empty:
+                transport = self.new_transport()
+
+            try:
+                return transport.request(*args, **kwargs)
+            finally:
+                self._idle.put(transport)
+
+    def close(self) -> None:
+        while True:
+            try:
+                transport = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            transport.http.close()
+
+
+def get_service(service_type: str, version: str):
+    """
+    Returns the google api service object, shared by the whole process
+
+    The service sends its requests through a pool of authorized transports
+    as large as the concurrency limit of the API, so it can be used from
+    many threads at once
+
+    ARGS:
+        type: type of service object (
+                gmail, sheets
+                )
+        version: version of the service object (
+                    v1 for gmail,
+                    v4 for sheets
+                    )
+
+    RETURNS:
+        googleapiclient.discovery.Resource: Google api service object
+    """
+    key = (service_type.strip(), version.strip())
+
+    with _lock:
+        if key in _services:
+            return _services[key]
+
+    try:
+        from googleapiclient.discovery import build
+
+        http = PooledHttp(get_credentials(), LIMITS[key[0]]["concurrency"])
+
+        # The discovery documents shipped with the client are used, so
+        # building the service doesn't fetch them over the network
+        service = build(
+            key[0],
+            key[1],
+            http=http,
+            static_discovery=True,
+            cache_discovery=False,
+        )
+
+    except Exception as e:
+        print(f"An error occured at get_service: {e}")
+        return None
+
+    with _lock:
+        return _services.setdefault(key, service)
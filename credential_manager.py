@@ -0,0 +1,287 @@
+import os
+import json
+import random
+import logging
+import datetime
+import tempfile
+import threading
+
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+
+
+# Seconds before the expiry of the token it is refreshed
+REFRESH_MARGIN = 5 * 60
+
+# Seconds to wait before trying again when a refresh failed
+RETRY_DELAY = 30
+
+# Up to how many seconds the refreshes are moved earlier at random, so that
+# the processes sharing the token file don't all wake up at once
+REFRESH_JITTER = 60
+
+
+def utcnow() -> datetime.datetime:
+    # The expiry of the credentials is a naive UTC datetime
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+class SharedCredentials(Credentials):
+    def __init__(self, *args, **kwargs):
+        """
+        Initializes the SharedCredentials class, credentials used by many
+        threads at once that are refreshed by only one of them
+
+        ARGS:
+            args: Arguments of google.oauth2.credentials.Credentials
+            kwargs: Keyword arguments of google.oauth2.credentials.Credentials
+
+        RETURNS:
+            None
+        """
+        super().__init__(*args, **kwargs)
+        self.store = None
+        self._refresh_lock = threading.Lock()
+
+    def refresh(self, request) -> None:
+        """
+        Refreshes the token, unless another thread or process refreshed it
+        while this one was waiting
+
+        ARGS:
+            request: google.auth.transport.Request used to refresh it
+
+        RETURNS:
+            None
+        """
+        seen = self.token
+        with self._refresh_lock:
+            if self.token != seen and self.valid:
+                return
+            if self.store is None:
+                super().refresh(request)
+                return
+
+            # The other processes wait for this refresh, then use its token
+            with self.store.file_lock(exclusive=True):
+                if self.store.adopt(self):
+                    return
+
+                super().refresh(request)
+                self.store.write(self)
+
+
+class CredentialManager:
+    def __init__(
+        self,
+        path: str = "token.json",
+        secrets_path: str = "credentials.json",
+        scopes: list = None,
+        margin: float = REFRESH_MARGIN,
+    ):
+        """
+        Initializes the CredentialManager class that keeps the credentials
+        of the user in memory, refreshes them in the background before they
+        expire and saves them to the token file
+
+        ARGS:
+            path: Path of the token file
+            secrets_path: Path of the client secrets, used when the user
+                          has to sign in
+            scopes: Scopes of the credentials
+            margin: Seconds before the expiry the token is refreshed
+
+        RETURNS:
+            None
+        """
+        self.path = path
+        self.secrets_path = secrets_path
+        self.scopes = scopes
+        self.margin = margin
+
+        self._creds = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        # How many times each thread holds the file lock
+        self._held = threading.local()
+
+    def get(self) -> SharedCredentials:
+        """
+        Returns the credentials, loading them the first time
+
+        ARGS:
+            None
+
+        RETURNS:
+            The credentials
+        """
+        with self._lock:
+            if self._creds is None:
+                self._creds = self.load()
+                self._thread = threading.Thread(target=self._refresh_loop, daemon=True)
+                self._thread.start()
+            return self._creds
+
+    def load(self) -> SharedCredentials:
+        """
+        Reads the saved credentials, refreshing them if they expired, or
+        asks the user to sign in
+
+        ARGS:
+            None
+
+        RETURNS:
+            The credentials
+        """
+        creds = self.read()
+
+        if creds is None or not creds.refresh_token:
+            from google_auth_oauthlib.flow import InstalledAppFlow
+
+            flow = InstalledAppFlow.from_client_secrets_file(self.secrets_path, self.scopes)
+            signed_in = flow.run_local_server(port=0)
+            creds = SharedCredentials.from_authorized_user_info(
+                json.loads(signed_in.to_json()), self.scopes
+            )
+            self.write(creds)
+
+        creds.store = self
+        if self.expiring(creds):
+            creds.refresh(Request())
+        return creds
+
+    def expiring(self, creds: Credentials) -> bool:
+        if creds.expiry is None:
+            return not creds.token
+        return (creds.expiry - utcnow()).total_seconds() < self.margin
+
+    def adopt(self, creds: SharedCredentials) -> bool:
+        """
+        Uses the token saved by another process, if it is still fresh
+
+        ARGS:
+            creds: The credentials to update
+
+        RETURNS:
+            True if the saved token was used
+        """
+        stored = self.read()
+        if stored is None or stored.token == creds.token or self.expiring(stored):
+            return False
+
+        creds.token = stored.token
+        creds.expiry = stored.expiry
+        return True
+
+    @contextmanager
+    def file_lock(self, exclusive: bool):
+        # Other processes (like another run or the daemon) use the same file,
+        # a thread already holding the lock keeps it (the refresh reads and
+        # writes the file under an exclusive lock)
+        depth = getattr(self._held, "depth", 0)
+        if fcntl is None or depth:
+            self._held.depth = depth + 1
+            try:
+                yield
+            finally:
+                self._held.depth = depth
+            return
+
+        with open(self.path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            self._held.depth = 1
+            try:
+                yield
+            finally:
+                self._held.depth = 0
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def read(self) -> SharedCredentials:
+        """
+        Reads the token file
+
+        ARGS:
+            None
+
+        RETURNS:
+            The saved credentials, or None if there are none
+        """
+        if not os.path.exists(self.path):
+            return None
+
+        with self.file_lock(exclusive=False):
+            try:
+                with open(self.path, "r") as file:
+                    info = json.load(file)
+            except (OSError, ValueError):
+                return None
+
+        try:
+            return SharedCredentials.from_authorized_user_info(info, self.scopes)
+        except ValueError:
+            return None
+
+    def write(self, creds: Credentials) -> None:
+        """
+        Saves the credentials to the token file, replacing it atomically
+
+        ARGS:
+            creds: The credentials
+
+        RETURNS:
+            None
+        """
+        directory = os.path.dirname(os.path.abspath(self.path))
+
+        with self.file_lock(exclusive=True):
+            # Only readable by the user, like the file it replaces
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".token-", suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w") as file:
+                    file.write(creds.to_json())
+                    file.flush()
+                    os.fsync(file.fileno())
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _refresh_loop(self) -> None:
+        delay = None
+        while True:
+            if delay is None:
+                token = self._creds.token
+                expiry = self._creds.expiry
+                if expiry is None:
+                    delay = self.margin
+                else:
+                    delay = (expiry - utcnow()).total_seconds() - self.margin
+                delay -= random.uniform(0, REFRESH_JITTER)
+
+            if self._stop.wait(max(delay, 0)):
+                return
+
+            # Refreshed by a request in the meantime
+            if self._creds.token != token and not self.expiring(self._creds):
+                delay = None
+                continue
+
+            try:
+                self._creds.refresh(Request())
+                delay = None
+            except Exception as e:
+                logging.warning(f"Couldn't refresh the credentials, retrying: {e}")
+                delay = RETRY_DELAY + random.uniform(0, RETRY_DELAY)
@@ -0,0 +1,200 @@
+import json
+import time
+import base64
+import random
+import logging
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Gmail watches expire after 7 days, they are renewed every day
+WATCH_RENEWAL = 24 * 60 * 60
+
+
+class Daemon:
+    def __init__(
+        self,
+        gmail_worker,
+        pipeline,
+        state,
+        days: int,
+        interval: float = 60,
+        jitter: float = 0.1,
+        push_port: int = None,
+        topic: str = None,
+    ):
+        """
+        Initializes the Daemon class that keeps the workers, the models and
+        the sheet index loaded and processes the new emails as they arrive
+
+        ARGS:
+            gmail_worker: GmailWorker used to list the new emails
+            pipeline: Pipeline processing the emails
+            state: StateStore keeping the history id of the mailbox
+            days: Number of days to look into when there is no history
+            interval: Seconds between two checks of the mailbox
+            jitter: Fraction of the interval the checks are randomly moved by
+            push_port: Local port receiving Pub/Sub push notifications of
+                       Gmail, if any
+            topic: Pub/Sub topic Gmail publishes the notifications to, if any
+
+        RETURNS:
+            None
+        """
+        self.gmail_worker = gmail_worker
+        self.pipeline = pipeline
+        self.state = state
+        self.days = days
+        self.interval = interval
+        self.jitter = jitter
+        self.push_port = push_port
+        self.topic = topic
+
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._server = None
+        self._watched = None
+
+    def run(self) -> None:
+        """
+        Checks the mailbox until interrupted
+
+        ARGS:
+            None
+
+        RETURNS:
+            None
+        """
+        if self.push_port:
+            self.serve_push(self.push_port)
+
+        print("Watching the mailbox, press Ctrl+C to stop")
+        try:
+            while not self._stop.is_set():
+                self.renew_watch()
+                self.sync()
+
+                # Wait for the next check or a notification
+                delay = self.interval * (1 + random.uniform(-self.jitter, self.jitter))
+                self._wake.wait(max(delay, 0))
+                self._wake.clear()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def sync(self) -> None:
+        """
+        Processes the emails added since the last check, and the ones
+        previous checks couldn't finish
+
+        ARGS:
+            None
+
+        RETURNS:
+            None
+        """
+        try:
+            history_id = self.state.get("history_id")
+            emails = self.gmail_worker.iter_new_messages(
+                history_id, self.days, "unread", "inbox"
+            )
+
+            # The history won't list the unfinished emails again
+            if self.pipeline.ledger is not None:
+                emails = self.pipeline.ledger.with_incomplete(emails)
+            self.pipeline.run(emails)
+
+            if self.gmail_worker.history_id:
+                self.state.set("history_id", self.gmail_worker.history_id)
+
+        except Exception as e:
+            logging.error(f"An error occured while checking the mailbox: {e}")
+
+    def notify(self) -> None:
+        """
+        Triggers a check of the mailbox
+
+        ARGS:
+            None
+
+        RETURNS:
+            None
+        """
+        self._wake.set()
+
+    def stop(self) -> None:
+        """
+        Stops the daemon
+
+        ARGS:
+            None
+
+        RETURNS:
+            None
+        """
+        self._stop.set()
+        self._wake.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
+
+    def renew_watch(self) -> None:
+        """
+        Asks Gmail to publish the changes of the inbox to the topic, once a day
+
+        ARGS:
+            None
+
+        RETURNS:
+            None
+        """
+        if not self.topic:
+            return
+        if self._watched is not None and time.time() - self._watched < WATCH_RENEWAL:
+            return
+
+        try:
+            self.gmail_worker.watch(self.topic, ["INBOX"])
+            self._watched = time.time()
+        except Exception as e:
+            logging.error(f"An error occured while watching the mailbox: {e}")
+
+    def serve_push(self, port: int) -> None:
+        """
+        Receives the Pub/Sub push notifications of Gmail on a local port
+
+        ARGS:
+            port: The port
+
+        RETURNS:
+            None
+        """
+        daemon = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length)
+
+                try:
+                    message = json.loads(body)["message"]
+                    data = json.loads(base64.b64decode(message["data"]))
+                    print(f"New activity in {data.get('emailAddress')}")
+                except (ValueError, KeyError, TypeError):
+                    self.send_response(400)
+                    self.end_headers()
+                    return
+
+                # Acknowledge the message before processing the emails
+                self.send_response(204)
+                self.end_headers()
+                daemon.notify()
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        print(f"Listening for Gmail notifications on port {port}")
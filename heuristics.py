@@ -0,0 +1,234 @@
+import re
+import math
+import threading
+
+
+# Domains of the applicant tracking systems that send application updates
+ATS_DOMAINS = {
+    "greenhouse.io",
+    "greenhouse-mail.io",
+    "lever.co",
+    "hire.lever.co",
+    "myworkday.com",
+    "myworkdayjobs.com",
+    "workday.com",
+    "smartrecruiters.com",
+    "icims.com",
+    "jobvite.com",
+    "ashbyhq.com",
+    "taleo.net",
+    "successfactors.com",
+    "bamboohr.com",
+    "workablemail.com",
+    "recruitee.com",
+    "breezy.hr",
+    "jazzhr.com",
+    "applytojob.com",
+    "hackerrank.com",
+    "codesignal.com",
+    "hirevue.com",
+}
+
+# Domains only used for notifications and bulk mail, never by recruiters
+# (companies that also hire, like uber.com, are not listed)
+DENIED_DOMAINS = {
+    "facebookmail.com",
+    "redditmail.com",
+    "mcsv.net",
+    "mailchimp.com",
+    "mailchimpapp.net",
+    "sendgrid.net",
+    "substack.com",
+}
+
+# How much a denied sender domain counts against an application email, the
+# subject and the message can still outweigh it
+DENIED_DOMAIN_WEIGHT = -3.0
+
+# Keywords in the subject and how much they count towards an application email
+SUBJECT_KEYWORDS = {
+    "application": 2.0,
+    "applying": 2.0,
+    "applied": 1.5,
+    "interview": 2.0,
+    "assessment": 2.0,
+    "offer letter": 2.0,
+    "candidate": 1.5,
+    "candidacy": 2.0,
+    "your interest": 1.5,
+    "position": 1.0,
+    "recruit": 1.0,
+    "next steps": 1.0,
+    "newsletter": -2.5,
+    "receipt": -2.5,
+    "your order": -2.5,
+    "invoice": -2.5,
+    "% off": -2.5,
+    "sale": -1.5,
+    "webinar": -2.0,
+    "digest": -2.0,
+    "job alert": -2.5,
+    "jobs for you": -2.5,
+    "recommended jobs": -2.5,
+    "password": -2.0,
+    "verify your": -2.0,
+}
+
+# Small labelled corpus the bag-of-words model is trained on
+TRAINING_DATA = [
+    ("Thank you for applying to the Software Engineer position", True),
+    ("We have received your application for the Data Analyst role", True),
+    ("Your application to Acme has been submitted", True),
+    ("Thank you for your interest in joining our team", True),
+    ("We would like to invite you to an interview", True),
+    ("Please complete the online assessment for the internship", True),
+    ("Next steps in your candidacy for the backend engineer role", True),
+    ("Unfortunately we will not be moving forward with your application", True),
+    ("After careful consideration we have decided to pursue other candidates", True),
+    ("We are pleased to offer you the position", True),
+    ("Schedule your technical interview with our recruiting team", True),
+    ("Your coding challenge invitation from our hiring team", True),
+    ("Update on your application status", True),
+    ("The hiring manager reviewed your resume", True),
+    ("Application confirmation for the summer internship program", True),
+    ("Thank you for your time interviewing with us", True),
+    ("Your weekly newsletter with the top stories", False),
+    ("Your order has shipped and is on its way", False),
+    ("Receipt for your payment", False),
+    ("Get 50% off everything this weekend only", False),
+    ("Someone commented on your post", False),
+    ("You have new friend suggestions", False),
+    ("Your monthly statement is ready", False),
+    ("Register for our upcoming webinar", False),
+    ("New jobs matching your search alert", False),
+    ("Reset your password", False),
+    ("Verify your email address to finish signing up", False),
+    ("Your subscription will renew soon", False),
+    ("Here is your daily digest of trending posts", False),
+    ("Your ride receipt and trip summary", False),
+    ("Flash sale ends tonight shop now", False),
+    ("Security alert a new sign in to your account", False),
+]
+
+
+class HeuristicClassifier:
+    def __init__(
+        self,
+        threshold: float = 0.9,
+        allowed_domains: set = None,
+        denied_domains: set = None,
+    ):
+        """
+        Initializes the HeuristicClassifier class that decides locally
+        whether an email is regarding a job application when it is obvious,
+        so that only the ambiguous emails are sent to the model
+
+        ARGS:
+            threshold: Minimum confidence for a local decision
+            allowed_domains: Sender domains of application emails (defaults
+                             to the applicant tracking systems)
+            denied_domains: Sender domains that are unlikely to send
+                            application emails
+
+        RETURNS:
+            None
+        """
+        self.threshold = threshold
+        self.allowed_domains = set(ATS_DOMAINS if allowed_domains is None else allowed_domains)
+        self.denied_domains = set(DENIED_DOMAINS if denied_domains is None else denied_domains)
+
+        # Imported here so that starting the program doesn't wait for nltk
+        from nltk import word_tokenize
+        from nltk.classify import NaiveBayesClassifier
+        from nltk.corpus import stopwords
+
+        self.tokenize = word_tokenize
+        self.stop_words = set(stopwords.words("english"))
+        self.model = NaiveBayesClassifier.train(
+            [(self.features(text), label) for text, label in TRAINING_DATA]
+        )
+
+        # Number of emails decided without the model
+        self.saved = 0
+        self._lock = threading.Lock()
+
+    def features(self, text: str) -> dict:
+        """
+        Returns the bag of words features of the text
+
+        ARGS:
+            text: The text
+
+        RETURNS:
+            The words of the text that are not stop words
+        """
+        return {
+            word: True
+            for word in self.tokenize(text.lower())
+            if word.isalpha() and word not in self.stop_words
+        }
+
+    def classify(self, details: dict) -> tuple:
+        """
+        Classifies the email
+
+        ARGS:
+            details: Details of the email (the message is optional)
+
+        RETURNS:
+            True if the email is likely regarding a job application else
+            False, and the confidence of the answer
+        """
+        domain = self.sender_domain(details.get("sender", ""))
+
+        if self.matches(domain, self.allowed_domains):
+            return True, 0.95
+
+        subject = details.get("subject", "")
+        text = subject
+        if details.get("message"):
+            # Only the beginning of the message, without the html tags
+            text += " " + re.sub(r"<[^>]*>", " ", details["message"][:2000])
+
+        # Combine the model and the subject keywords in log odds
+        prob = self.model.prob_classify(self.features(text)).prob(True)
+        prob = min(max(prob, 0.01), 0.99)
+        score = math.log(prob / (1 - prob))
+
+        if self.matches(domain, self.denied_domains):
+            score += DENIED_DOMAIN_WEIGHT
+
+        subject = subject.lower()
+        for keyword, weight in SUBJECT_KEYWORDS.items():
+            if keyword in subject:
+                score += weight
+
+        prob = 1 / (1 + math.exp(-score))
+        return prob >= 0.5, max(prob, 1 - prob)
+
+    def is_irrelevant(self, details: dict) -> bool:
+        """
+        Checks if the email is confidently not regarding a job application
+
+        ARGS:
+            details: Details of the email (the message is optional)
+
+        RETURNS:
+            True if the email can be skipped without asking the model
+        """
+        is_app, confidence = self.classify(details)
+        if is_app or confidence < self.threshold:
+            return False
+
+        with self._lock:
+            self.saved += 1
+        return True
+
+    @staticmethod
+    def sender_domain(sender: str) -> str:
+        match = re.search(r"@([\w.-]+)", sender)
+        return match.group(1).lower() if match else ""
+
+    @staticmethod
+    def matches(domain: str, domains: set) -> bool:
+        return any(domain == d or domain.endswith("." + d) for d in domains)
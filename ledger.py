@@ -0,0 +1,206 @@
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+
+
+# Stages of an email, in order
+STAGES = ["fetched", "classified", "extracted", "written"]
+
+# Stages after which there is nothing left to do for an email
+DONE_STAGES = {"written", "skipped", "failed"}
+
+
+class Ledger:
+    def __init__(self, path: str = "ledger.sqlite3"):
+        """
+        Initializes the Ledger class that records the last stage each email
+        went through, so that an interrupted run can be resumed
+
+        ARGS:
+            path: Path of the SQLite file
+
+        RETURNS:
+            None
+        """
+        self.path = path
+
+        # Emails not processed again in this run, by their stage
+        self.skipped = {}
+        self.resumed = {}
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS messages (
+                id TEXT PRIMARY KEY,
+                stage TEXT NOT NULL,
+                content_hash TEXT,
+                payload TEXT,
+                updated REAL NOT NULL
+            )
+            """
+        )
+
+        # Ledgers of older versions don't count the attempts
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(messages)")]
+        if "attempts" not in columns:
+            self._conn.execute(
+                "ALTER TABLE messages ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0"
+            )
+        self._conn.commit()
+
+    @staticmethod
+    def content_hash(message: str) -> str:
+        if message is None:
+            return None
+        return hashlib.sha256(message.encode("utf-8")).hexdigest()
+
+    def get(self, msg_id: str) -> dict:
+        """
+        Returns the last recorded stage of the email
+
+        ARGS:
+            msg_id: Id of the email
+
+        RETURNS:
+            The stage, the content hash and the payload saved with it, or
+            None if the email was never recorded
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT stage, content_hash, payload FROM messages WHERE id = ?",
+                (msg_id,),
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        return {
+            "stage": row[0],
+            "content_hash": row[1],
+            "payload": json.loads(row[2]) if row[2] else None,
+        }
+
+    def record(
+        self,
+        msg_id: str,
+        stage: str,
+        payload=None,
+        message: str = None,
+    ) -> None:
+        """
+        Records the stage the email went through
+
+        ARGS:
+            msg_id: Id of the email
+            stage: The stage (one of STAGES, skipped when the email is
+                   not regarding a job application, or failed when it
+                   couldn't be processed after many attempts)
+            payload: What is needed to resume from the stage
+            message: The email message, to record its hash
+
+        RETURNS:
+            None
+        """
+        with self._lock:
+            self._conn.execute(
+                """
+                INSERT INTO messages (id, stage, content_hash, payload, updated)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET
+                    stage = excluded.stage,
+                    content_hash = COALESCE(excluded.content_hash, content_hash),
+                    payload = excluded.payload,
+                    updated = excluded.updated
+                """,
+                (
+                    msg_id,
+                    stage,
+                    self.content_hash(message),
+                    json.dumps(payload) if payload is not None else None,
+                    time.time(),
+                ),
+            )
+            self._conn.commit()
+
+    def incomplete(self) -> list:
+        """
+        Returns the emails that didn't go through every stage
+
+        ARGS:
+            None
+
+        RETURNS:
+            The emails (with their id)
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id FROM messages WHERE stage NOT IN (%s) ORDER BY updated"
+                % ", ".join("?" * len(DONE_STAGES)),
+                tuple(DONE_STAGES),
+            ).fetchall()
+        return [{"id": row[0]} for row in rows]
+
+    def with_incomplete(self, emails):
+        """
+        Yields the emails that didn't go through every stage, then the
+        given ones that are not among them
+
+        ARGS:
+            emails: The emails to process (e.g. the new emails of the
+                    mailbox)
+
+        RETURNS:
+            Generator of the emails, each one once
+        """
+        seen = set()
+        for email in self.incomplete():
+            seen.add(email["id"])
+            yield email
+
+        for email in emails:
+            if email["id"] not in seen:
+                seen.add(email["id"])
+                yield email
+
+    def attempt(self, msg_id: str) -> int:
+        """
+        Counts a failed attempt at processing the email
+
+        ARGS:
+            msg_id: Id of the email
+
+        RETURNS:
+            The number of failed attempts so far
+        """
+        with self._lock:
+            self._conn.execute(
+                "UPDATE messages SET attempts = attempts + 1 WHERE id = ?", (msg_id,)
+            )
+            row = self._conn.execute(
+                "SELECT attempts FROM messages WHERE id = ?", (msg_id,)
+            ).fetchone()
+            self._conn.commit()
+        return row[0] if row else 1
+
+    def count(self, counts: dict, stage: str) -> None:
+        with self._lock:
+            counts[stage] = counts.get(stage, 0) + 1
+
+    def close(self) -> None:
+        """
+        Closes the ledger file
+
+        ARGS:
+            None
+
+        RETURNS:
+            None
+        """
+        with self._lock:
+            self._conn.close()
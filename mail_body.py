@@ -0,0 +1,269 @@
+import re
+import codecs
+import base64
+
+from html.parser import HTMLParser
+
+
+# Maximum number of tokens of the text of an email sent to the model
+MAX_TOKENS = 600
+
+# Rough number of characters per token of English text
+CHARS_PER_TOKEN = 4
+
+# Number of base64 characters decoded at once (a multiple of 4)
+CHUNK_SIZE = 16 * 1024
+
+# Lines starting a quoted reply or a forwarded email
+QUOTE_START = re.compile(
+    r"^(On .{1,200} wrote:?"
+    r"|-{2,} ?(Original|Forwarded) (Message|message) ?-{2,}"
+    r"|_{10,}"
+    r"|From: .{1,200} Sent: .*"
+    r"|Le .{1,200} a écrit ?:)$"
+)
+
+# Lines starting a signature or a footer added by the email client
+SIGNATURE_START = re.compile(
+    r"^(--|Sent from my \w+.*|Get Outlook for \w+.*|Sent via .{1,40})$"
+)
+
+# Tags whose text is not part of the message
+SKIPPED_TAGS = {"head", "title", "style", "script", "noscript", "template"}
+
+# Tags starting a new line of text
+BLOCK_TAGS = {
+    "p", "div", "br", "tr", "li", "ul", "ol", "table", "h1", "h2", "h3",
+    "h4", "h5", "h6", "hr", "section", "article", "header", "footer",
+}
+
+
+class TextCollector:
+    def __init__(self, max_chars: int):
+        """
+        Initializes the TextCollector class that keeps the lines of the
+        message until a quoted reply or a signature starts, or the budget
+        is reached
+
+        ARGS:
+            max_chars: Maximum number of characters kept
+
+        RETURNS:
+            None
+        """
+        self.max_chars = max_chars
+        self.lines = []
+        self.size = 0
+        self.done = False
+        self._pending = ""
+
+    def feed(self, text: str) -> None:
+        """
+        Adds the next piece of text
+
+        ARGS:
+            text: The text (lines may be split between two pieces)
+
+        RETURNS:
+            None
+        """
+        if self.done:
+            return
+
+        *lines, self._pending = (self._pending + text).split("\n")
+        for line in lines:
+            self.add_line(line)
+            if self.done:
+                return
+
+    def close(self) -> None:
+        self.add_line(self._pending)
+        self._pending = ""
+
+    def add_line(self, line: str) -> None:
+        if self.done:
+            return
+
+        line = " ".join(line.split())
+        if not line:
+            return
+        if QUOTE_START.match(line) or SIGNATURE_START.match(line):
+            self.done = True
+            return
+        if line.startswith(">"):
+            return
+
+        self.lines.append(line)
+        self.size += len(line) + 1
+        if self.size >= self.max_chars:
+            self.done = True
+
+    def text(self) -> str:
+        """
+        Returns the text kept, cut at the last word that fits in the budget
+
+        ARGS:
+            None
+
+        RETURNS:
+            The text
+        """
+        text = "\n".join(self.lines)
+        if len(text) > self.max_chars:
+            text = text[: self.max_chars].rsplit(" ", 1)[0]
+        return text
+
+
+class HTMLText(HTMLParser):
+    def __init__(self, collector: TextCollector):
+        """
+        Initializes the HTMLText class that converts html to text as it is
+        fed, passing the text to the collector
+
+        ARGS:
+            collector: TextCollector receiving the text
+
+        RETURNS:
+            None
+        """
+        super().__init__(convert_charrefs=True)
+        self.collector = collector
+        self._skipped = 0
+
+    def handle_starttag(self, tag: str, attrs: list) -> None:
+        if tag in SKIPPED_TAGS:
+            self._skipped += 1
+        elif tag == "blockquote" or "gmail_quote" in (dict(attrs).get("class") or ""):
+            # Quoted reply, nothing after it is part of the message
+            self.collector.close()
+            self.collector.done = True
+        elif tag in BLOCK_TAGS:
+            self.collector.feed("\n")
+
+    def handle_startendtag(self, tag: str, attrs: list) -> None:
+        if tag in BLOCK_TAGS:
+            self.collector.feed("\n")
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag in SKIPPED_TAGS:
+            self._skipped = max(0, self._skipped - 1)
+        elif tag in BLOCK_TAGS:
+            self.collector.feed("\n")
+
+    def handle_data(self, data: str) -> None:
+        if not self._skipped:
+            # Line breaks of the html source are only spaces
+            self.collector.feed(data.replace("\r", " ").replace("\n", " "))
+
+
+def header(part: dict, name: str) -> str:
+    for h in part.get("headers", []):
+        if h["name"].lower() == name.lower():
+            return h["value"]
+    return ""
+
+
+def is_attachment(part: dict) -> bool:
+    return bool(
+        part.get("filename")
+        or "attachmentId" in part.get("body", {})
+        or header(part, "Content-Disposition").lower().startswith("attachment")
+    )
+
+
+def find_part(payload: dict, mime_type: str) -> dict:
+    """
+    Returns the first part of the email of the given type that is not an
+    attachment
+
+    ARGS:
+        payload: Payload of the email, as returned by the Gmail API
+        mime_type: Type of the part (e.g. text/plain)
+
+    RETURNS:
+        The part, or None if there is none
+    """
+    if payload.get("mimeType", "").lower() == mime_type:
+        if not is_attachment(payload) and payload.get("body", {}).get("data"):
+            return payload
+
+    for part in payload.get("parts", []):
+        found = find_part(part, mime_type)
+        if found:
+            return found
+    return None
+
+
+def charset(part: dict) -> str:
+    match = re.search(r'charset="?([\w.:-]+)', header(part, "Content-Type"), re.I)
+    if match:
+        try:
+            return codecs.lookup(match.group(1)).name
+        except LookupError:
+            pass
+    return "utf-8"
+
+
+def decode_chunks(part: dict):
+    """
+    Yields the text of the part, decoding its body a chunk at a time
+
+    ARGS:
+        part: The part
+
+    RETURNS:
+        Generator of the pieces of text
+    """
+    data = part["body"]["data"]
+    decoder = codecs.getincrementaldecoder(charset(part))(errors="replace")
+
+    for i in range(0, len(data), CHUNK_SIZE):
+        chunk = data[i : i + CHUNK_SIZE]
+        last = i + CHUNK_SIZE >= len(data)
+        if last:
+            chunk += "=" * (-len(chunk) % 4)
+        yield decoder.decode(base64.urlsafe_b64decode(chunk), final=last)
+
+
+def extract_text(payload: dict, max_tokens: int = MAX_TOKENS) -> str:
+    """
+    Returns the text of the email, without the quoted replies and the
+    signature, cut to the token budget
+
+    The plain text part is preferred, the html part is converted to text
+    otherwise. The body is decoded a chunk at a time and only until the
+    message ends or the budget is reached
+
+    ARGS:
+        payload: Payload of the email, as returned by the Gmail API
+        max_tokens: Maximum number of tokens of the text
+
+    RETURNS:
+        The text, or None if the email has no text
+    """
+    for mime_type in ("text/plain", "text/html"):
+        part = find_part(payload, mime_type)
+        if part is None:
+            continue
+
+        collector = TextCollector(max_tokens * CHARS_PER_TOKEN)
+        parser = HTMLText(collector) if mime_type == "text/html" else None
+
+        for text in decode_chunks(part):
+            if parser is not None:
+                parser.feed(text)
+            else:
+                collector.feed(text)
+            if collector.done:
+                break
+
+        if parser is not None and not collector.done:
+            parser.close()
+        collector.close()
+
+        # Some plain text parts only ask to open the html version
+        text = collector.text()
+        if text:
+            return text
+
+    return None
@@ -1,35 +1,182 @@
-import sys
 import os
-import pprint
-import datetime
-import base64
-import re
 import time
-import logging
-
-import concurrent.futures
-import multiprocessing
+import argparse
+import itertools
 
 from dotenv import load_dotenv
 
-from palm_utils import Processor
-from workers import GmailWorker, SheetsWorker
+import nlp_service
+from cache import ResponseCache
+from daemon import Daemon
+from heuristics import HeuristicClassifier
+from ledger import Ledger
+from metrics import metrics
+from palm_utlis import Processor
+from pipeline import Pipeline, DEFAULT_CONCURRENCY
+from state import StateStore
+from workers import GmailWorker, SheetsWorker, BATCH_SIZE
 
 
 load_dotenv()
 
-# Create Workers
-gmail_worker = GmailWorker()
-sheets_worker = SheetsWorker()
-processor = Processor(os.environ.get("API_KEY"))
+# Maximum number of days to look into
+MAX_DAYS = 49
 
 
 def main():
-    # Get user input
-    days = get_days()
+    args = parse_args()
+
+    # Stage of the emails seen by previous runs
+    ledger = Ledger()
+
+    if args.watch:
+        watch(args, ledger)
+        return
+
+    if args.resume:
+        # Only finish the emails interrupted in previous runs
+        state = None
+        gmail_worker = GmailWorker()
+        incomplete = ledger.incomplete()
+        if not incomplete:
+            print("There are no interrupted emails to resume.")
+        emails = iter(incomplete)
+    else:
+        # History of the mailbox from the previous run
+        state = StateStore()
+        history_id = state.get("history_id") if args.incremental else None
+
+        # Get user input, incremental runs only need it when the history expired
+        if history_id and not args.days:
+            days = MAX_DAYS
+        else:
+            days = get_days(args.days)
+
+        # The workers are created only when they are needed
+        gmail_worker = GmailWorker()
+
+        # Get all emails, processing starts while the later pages are listed
+        emails = gmail_worker.iter_new_messages(history_id, days, "unread", "inbox")
+
+        # The history won't list the emails previous runs couldn't finish
+        if history_id:
+            emails = ledger.with_incomplete(emails)
+
+    # Nothing else to do without emails
+    first = next(emails, None)
+    if first is None:
+        save_history(state, gmail_worker)
+        return
+    emails = itertools.chain([first], emails)
+
+    pipeline = create_pipeline(args, gmail_worker, ledger)
+    app_categories = pipeline.run(emails)
+    save_history(state, gmail_worker)
+
+    # Print the details of the session
+    print_session_details(
+        app_categories, pipeline.processor.cache, pipeline.classifier, ledger
+    )
+    write_report(
+        args.report, app_categories, pipeline.processor.cache, pipeline.classifier, ledger
+    )
+
+
+def watch(args: argparse.Namespace, ledger: Ledger) -> None:
+    """
+    Keeps processing the new emails as they arrive, until interrupted
+
+    ARGS:
+        args: The parsed command line arguments
+        ledger: Ledger recording the stage of each email
+
+    RETURNS:
+        None
+    """
+    state = StateStore()
+
+    # Days to look into when there is no history of the mailbox yet
+    if state.get("history_id") and not args.days:
+        days = MAX_DAYS
+    else:
+        days = get_days(args.days)
+
+    # Everything is loaded once and kept for every check
+    gmail_worker = GmailWorker()
+    pipeline = create_pipeline(args, gmail_worker, ledger)
+
+    daemon = Daemon(
+        gmail_worker,
+        pipeline,
+        state,
+        days,
+        interval=args.interval,
+        jitter=args.jitter,
+        push_port=args.push_port,
+        topic=args.topic,
+    )
+    daemon.run()
+
+    # Print the details of the session
+    print_session_details(
+        pipeline.app_categories, pipeline.processor.cache, pipeline.classifier, ledger
+    )
+    write_report(
+        args.report,
+        pipeline.app_categories,
+        pipeline.processor.cache,
+        pipeline.classifier,
+        ledger,
+    )
+
+
+def save_history(state: StateStore, gmail_worker: GmailWorker) -> None:
+    """
+    Saves the history id of the mailbox for the next incremental run
+
+    ARGS:
+        state: The local state store
+        gmail_worker: GmailWorker that listed the emails
 
-    # Get all emails
-    emails = gmail_worker.get_messages(days, "unread", "inbox")
+    RETURNS:
+        None
+    """
+    if state is not None and gmail_worker.history_id:
+        state.set("history_id", gmail_worker.history_id)
+
+
+def create_pipeline(
+    args: argparse.Namespace,
+    gmail_worker: GmailWorker,
+    ledger: Ledger = None,
+    sheets_worker: SheetsWorker = None,
+    processor: Processor = None,
+) -> Pipeline:
+    """
+    Creates the workers and the pipeline processing the emails
+
+    ARGS:
+        args: The parsed command line arguments
+        gmail_worker: GmailWorker used to read the emails
+        ledger: Ledger recording the stage of each email
+        sheets_worker: SheetsWorker used to write the sheet (created if
+                       not given)
+        processor: Processor extracting the details (created if not given)
+
+    RETURNS:
+        The pipeline
+    """
+    if args.spacy_model:
+        os.environ["SPACY_MODEL"] = args.spacy_model
+    if args.vectors_only:
+        os.environ["SPACY_VECTORS_ONLY"] = "1"
+
+    if sheets_worker is None:
+        sheets_worker = SheetsWorker()
+    if processor is None:
+        processor = Processor(
+            os.environ.get("API_KEY"), None if args.no_cache else ResponseCache()
+        )
 
     # Creating the sheet
     sheets_worker.create_sheet("jobsheet")
@@ -39,68 +186,176 @@ def main():
     sheet_id = sheet[0].strip()
     sheet_name = sheet[1].strip()
 
-    # Multiprocessing the emails
-    with multiprocessing.Manager() as manager:
-        app_categories = manager.dict(
-            {
-                "application": 0,
-                "assessment": 0,
-                "interview": 0,
-                "offer": 0,
-                "rejection": 0,
-            }
+    # Local classifier for the obviously irrelevant emails
+    classifier = None
+    prefilter = None
+    if not args.no_prefilter:
+        classifier = HeuristicClassifier(args.prefilter_threshold)
+        prefilter = lambda headers: not classifier.is_irrelevant(headers)
+
+    # Process the emails concurrently
+    return Pipeline(
+        gmail_worker,
+        sheets_worker,
+        processor,
+        sheet_id,
+        sheet_name,
+        concurrency={
+            stage: getattr(args, stage) for stage in DEFAULT_CONCURRENCY
+        },
+        queue_size=args.queue_size,
+        batch_size=args.batch_size,
+        prefilter=prefilter,
+        classifier=classifier,
+        flush_size=args.flush_size,
+        flush_interval=args.flush_interval,
+        ledger=ledger,
+    )
+
+
+def parse_args(argv: list = None) -> argparse.Namespace:
+    """
+    Parses the command line arguments
+
+    ARGS:
+        argv: The arguments (defaults to the ones of the program)
+
+    RETURNS:
+        The parsed arguments
+    """
+    parser = argparse.ArgumentParser(
+        description="Tracks the job applications from gmail in a google sheet"
+    )
+    parser.add_argument(
+        "days", nargs="?", type=int, help=f"Number of days to look into (1-{MAX_DAYS})"
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep running and process the new emails as they arrive",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=60,
+        metavar="SECONDS",
+        help="Seconds between two checks of the mailbox with --watch (default: 60)",
+    )
+    parser.add_argument(
+        "--jitter",
+        type=float,
+        default=0.1,
+        metavar="FRACTION",
+        help="Fraction of the interval the checks are randomly moved by (default: 0.1)",
+    )
+    parser.add_argument(
+        "--push-port",
+        type=int,
+        metavar="PORT",
+        help="Local port receiving Pub/Sub push notifications of Gmail with --watch",
+    )
+    parser.add_argument(
+        "--topic",
+        metavar="NAME",
+        help="Pub/Sub topic Gmail should publish the changes of the inbox to",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Only finish the emails interrupted in previous runs",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help=(
+            "Only look at the emails added since the previous run, or at the "
+            f"last days ({MAX_DAYS} by default) when the mailbox history expired"
+        ),
+    )
+    for stage, workers in DEFAULT_CONCURRENCY.items():
+        parser.add_argument(
+            f"--{stage}",
+            type=int,
+            default=workers,
+            metavar="N",
+            help=f"Number of concurrent {stage} workers (default: {workers})",
         )
-        locked_range = manager.dict()
-
-        with concurrent.futures.ProcessPoolExecutor(2) as executor:
-            results = []
-
-            for email in emails:
-                new_entry_lock = manager.Lock()  # Lock for each email
-                category_locks = {
-                    key: manager.Lock() for key in app_categories
-                }  # Lock for each vategory
-                results.append(
-                    executor.submit(
-                        process_email,
-                        email,
-                        app_categories,
-                        new_entry_lock,
-                        category_locks,
-                        locked_range,
-                        sheet_id,
-                        sheet_name,
-                    )
-                )
-
-            # Wait for all processes
-            concurrent.futures.wait(results)
-
-            # Print the details of the session
-            print_session_details(app_categories)
-
-
-def get_days() -> int:
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=32,
+        metavar="N",
+        help="Maximum number of emails waiting between two stages (default: 32)",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=BATCH_SIZE,
+        metavar="N",
+        help=f"Number of emails fetched per batch request, 1 to disable (default: {BATCH_SIZE})",
+    )
+    parser.add_argument(
+        "--flush-size",
+        type=int,
+        default=200,
+        metavar="N",
+        help="Number of buffered sheet updates that triggers a write (default: 200)",
+    )
+    parser.add_argument(
+        "--flush-interval",
+        type=float,
+        default=60,
+        metavar="SECONDS",
+        help="Seconds after which buffered sheet updates are written (default: 60)",
+    )
+    parser.add_argument(
+        "--prefilter-threshold",
+        type=float,
+        default=0.9,
+        metavar="P",
+        help="Confidence needed to skip an email without asking the model (default: 0.9)",
+    )
+    parser.add_argument(
+        "--no-prefilter",
+        action="store_true",
+        help="Ask the model about every email",
+    )
+    parser.add_argument(
+        "--report",
+        default="run_report.json",
+        metavar="PATH",
+        help="Where to write the JSON report of the run (default: run_report.json)",
+    )
+    parser.add_argument(
+        "--spacy-model",
+        metavar="NAME",
+        help="spaCy model to load (default: SPACY_MODEL or en_core_web_lg)",
+    )
+    parser.add_argument(
+        "--vectors-only",
+        action="store_true",
+        help="Load only the word vectors of the spaCy model",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Ask the model again instead of using the cached responses",
+    )
+    return parser.parse_args(argv)
+
+
+def get_days(days: int = None) -> int:
     """
     Gets number of days from user
 
     ARGS:
-        None
+        days: Number of days given in the command line, if any
     
     RETURNS:
-        None
+        Number of days to look into
     """
-    days = None
-
-    # Try to get the query details from command line
-    if len(sys.argv) == 2:
-        try:
-            days = int(sys.argv[1])
-        except ValueError:
-            pass
-
     # Get input from the user
-    while not days or not (1 <= days < 50):
+    while not days or not (1 <= days <= MAX_DAYS):
         try:
             days = int(input("Enter the number of days to look into: "))
         except ValueError:
@@ -109,151 +364,20 @@ def get_days() -> int:
     return days
 
 
-def process_email(
-    email,
-    app_categories,
-    new_entry_lock,
-    category_locks,
-    locked_range,
-    sheet_id,
-    sheet_name,
+def print_session_details(
+    app_categories: dict,
+    cache: ResponseCache = None,
+    classifier: HeuristicClassifier = None,
+    ledger: Ledger = None,
 ) -> None:
-    """
-    Processes the emails and updates the spreadsheet
-
-    ARGS:
-        email: The email to process
-        app_categories: Shared resource to keep track of updates made
-        new_entry_lock: Lock for new entries
-        category_locks: Lock for updating each category update count
-        locked_range: Shared resouece to keep track of ranges currently being updated
-        sheet_id: Id of the google sheet
-        sheet_name: Name of the google sheet
-
-    RETURNS:
-        None
-    """
-    try:
-        details = gmail_worker.get_mail_details(email)
-
-        if details:
-            if details["message"] != None:
-                # Check if the email is job application related
-                if processor.is_app_mail(details["message"]):
-                    info = processor.extract_info(details["message"])
-
-                    # Include meta data
-                    info["date"] = details["date"]
-                    info[
-                        "email"
-                    ] = f"https://mail.google.com/mail/u/{details['receiver'].strip()}/#inbox/{details['id'].strip()}"
-
-                    # Prepare the data to update the sheets
-                    values = list(info.values())
-
-                    # Check existing range
-                    prev_range = sheets_worker.get_existing_range(
-                        info["company"], info["role"]
-                    )
-
-                    # Create new entry if no previous entry
-                    if prev_range == None:
-                        sheet_new_range = sheets_worker.get_sheet_details()[2].strip()
-                        sheets_worker.update_sheet_details(1)
-                        new_entry_lock.acquire()
-                        try:
-                            sheets_worker.update_sheet(
-                                sheet_id,
-                                sheet_new_range,
-                                "USER_ENTERED",
-                                values,
-                            )
-
-                        finally:
-                            new_entry_lock.release()
-
-                    # Update the application entry
-                    else:
-                        # Check if the value is being updated
-                        while True:
-                            if prev_range in locked_range:
-                                time.sleep(0.1)
-                            else:
-                                break
-
-                        # Lock.acquire()
-                        locked_range[prev_range] = 1
-
-                        # Compare dates to make sure it is the latest message
-                        prev_range_values = sheets_worker.get_values(
-                            prev_range, sheet_id
-                        )
-                        date_pattern = (
-                            r"(\w{3}, \d{2} \w{3} \d{4} \d{2}:\d{2}:\d{2} [-+]\d{4})"
-                        )
-                        prev_date = None
-
-                        for val in prev_range_values:
-                            match = re.match(date_pattern, val)
-                            if match:
-                                prev_date = match.group(1).strip()
-                                break
-
-                        # prev_date = prev_range_values[2].strip()
-
-                        if prev_date != None:
-                            cur_date = info["date"].strip()
-                            cur_date = cur_date
-
-                            date_format = "%a, %d %b %Y %H:%M:%S %z"
-
-                            cur_date = datetime.strptime(cur_date, date_format)
-                            prev_date = datetime.strptime(prev_date, date_format)
-
-                            # Dont update if sheet's message is more recent
-                            if prev_date > cur_date:
-                                category_locks[info["status"].lower().strip()].acquire()
-                                app_categories[
-                                    info["status"].lower().strip()
-                                ] += 1  # Acknowledge the email
-                                category_locks[info["status"].lower().strip()].release()
-                                return
-
-                        sheets_worker.update_sheet(
-                            sheet_id, prev_range, "USER_ENTERED", values
-                        )
-
-                        # Lock.release()
-                        del locked_range[prev_range]
-
-                    # Update the count
-                    category_locks[info["status"].lower().strip()].acquire()
-                    app_categories[info["status"].lower().strip()] += 1
-                    category_locks[info["status"].lower().strip()].release()
-
-                    # Mark the email read
-                    gmail_worker.mark_read(details["id"].strip())
-
-            else:
-                # Inform the user
-                print(
-                    f'Email couldn\'t be read:\nemail id: {details["id"]}\nsender: {details["sender"]}\n'
-                )
-
-        else:
-            # Inform the user
-            print(f"This email couldn't be read: {email['id']}\n")
-
-    except Exception as e:
-        logging.error(e)
-
-
-def print_session_details(app_categories: dict) -> None:
     """
     Prints the session details
 
     ARGS:
         app_categories: Dictionary that has tracked all the updates count
+        cache: Cache of the model responses, if used
+        classifier: Local classifier of the emails, if used
+        ledger: Ledger of the emails, if used
     
     RETURNS:
         None
@@ -263,10 +387,56 @@ def print_session_details(app_categories: dict) -> None:
     for c in app_categories:
         if app_categories[c] > 0:
             print(f"{c.upper()}: {app_categories[c]}")
+    if cache is not None:
+        print(f"Model cache: {cache.hits} hits, {cache.misses} misses")
+    if classifier is not None:
+        print(f"Model calls saved by the prefilter: {classifier.saved}")
+    if ledger is not None:
+        for stage, n in ledger.skipped.items():
+            print(f"Skipped {n} emails already {stage} by a previous run")
+        for stage, n in ledger.resumed.items():
+            print(f"Resumed {n} emails that were {stage} by a previous run")
+    nlp = nlp_service.report()
+    if "model" in nlp:
+        print(f"spaCy model: {nlp['model']} loaded in {nlp['load_time']:.2f} seconds")
+    print(f"Peak memory: {nlp['peak_rss']:.0f} MB")
     print("\n- - - - - - - - - - - - - - - - - -\n")
+    metrics.print_summary()
     print(app_categories)
 
 
+def write_report(
+    path: str,
+    app_categories: dict,
+    cache: ResponseCache = None,
+    classifier: HeuristicClassifier = None,
+    ledger: Ledger = None,
+) -> None:
+    """
+    Writes the JSON report of the session (latencies, counters and updates)
+
+    ARGS:
+        path: Path of the report
+        app_categories: Dictionary that has tracked all the updates count
+        cache: Cache of the model responses, if used
+        classifier: Local classifier of the emails, if used
+        ledger: Ledger of the emails, if used
+
+    RETURNS:
+        None
+    """
+    extra = {"updates": dict(app_categories), "nlp": nlp_service.report()}
+    if cache is not None:
+        extra["cache"] = {"hits": cache.hits, "misses": cache.misses}
+    if classifier is not None:
+        extra["prefilter"] = {"saved": classifier.saved}
+    if ledger is not None:
+        extra["ledger"] = {"skipped": ledger.skipped, "resumed": ledger.resumed}
+
+    metrics.write_report(path, extra)
+    print(f"Report written to {path}")
+
+
 if __name__ == "__main__":
     start_time = time.time()
     main()
@@ -0,0 +1,165 @@
+import json
+import time
+import threading
+
+from contextlib import contextmanager
+
+
+class Metrics:
+    def __init__(self):
+        """
+        Initializes the Metrics class that records the latencies (as
+        histograms) and the counters of a run
+
+        ARGS:
+            None
+
+        RETURNS:
+            None
+        """
+        self.started = time.time()
+        self.histograms = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, name: str):
+        """
+        Records how long the block takes
+
+        ARGS:
+            name: Name of the histogram
+
+        RETURNS:
+            None
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def observe(self, name: str, seconds: float) -> None:
+        """
+        Records a latency
+
+        ARGS:
+            name: Name of the histogram
+            seconds: The latency
+
+        RETURNS:
+            None
+        """
+        with self._lock:
+            self.histograms.setdefault(name, []).append(seconds)
+
+    def incr(self, name: str, n: int = 1) -> None:
+        """
+        Increments a counter
+
+        ARGS:
+            name: Name of the counter
+            n: How much to increment it by
+
+        RETURNS:
+            None
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    @staticmethod
+    def percentile(values: list, p: float) -> float:
+        # Nearest rank on sorted values
+        index = max(0, min(len(values) - 1, int(round(p / 100 * len(values))) - 1))
+        return values[index]
+
+    def summary(self) -> dict:
+        """
+        Returns the summary of the histograms
+
+        ARGS:
+            None
+
+        RETURNS:
+            Count, total, mean, p50, p95, p99 and max (in seconds) of each
+            histogram
+        """
+        with self._lock:
+            histograms = {name: sorted(values) for name, values in self.histograms.items()}
+
+        summary = {}
+        for name, values in sorted(histograms.items()):
+            summary[name] = {
+                "count": len(values),
+                "total": sum(values),
+                "mean": sum(values) / len(values),
+                "p50": self.percentile(values, 50),
+                "p95": self.percentile(values, 95),
+                "p99": self.percentile(values, 99),
+                "max": values[-1],
+            }
+        return summary
+
+    def report(self, extra: dict = None) -> dict:
+        """
+        Returns the report of the run
+
+        ARGS:
+            extra: Other details to include in the report
+
+        RETURNS:
+            The report
+        """
+        with self._lock:
+            counters = dict(sorted(self.counters.items()))
+
+        report = {
+            "started": self.started,
+            "duration": time.time() - self.started,
+            "latencies": self.summary(),
+            "counters": counters,
+        }
+        report.update(extra or {})
+        return report
+
+    def write_report(self, path: str, extra: dict = None) -> dict:
+        """
+        Writes the report of the run as JSON
+
+        ARGS:
+            path: Path of the report
+            extra: Other details to include in the report
+
+        RETURNS:
+            The report
+        """
+        report = self.report(extra)
+        with open(path, "w") as file:
+            json.dump(report, file, indent=2)
+        return report
+
+    def print_summary(self) -> None:
+        """
+        Prints the percentiles of each histogram
+
+        ARGS:
+            None
+
+        RETURNS:
+            None
+        """
+        summary = self.summary()
+        if not summary:
+            return
+
+        width = max(len(name) for name in summary)
+        print(f"{'':{width}}  {'count':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'total':>9}")
+        for name, s in summary.items():
+            print(
+                f"{name:{width}}  {s['count']:>6} {s['p50'] * 1000:>6.0f}ms "
+                f"{s['p95'] * 1000:>6.0f}ms {s['p99'] * 1000:>6.0f}ms {s['total']:>8.2f}s"
+            )
+
+
+# Metrics of the current run, shared by every module
+metrics = Metrics()
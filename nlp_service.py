@@ -0,0 +1,106 @@
+import os
+import sys
+import time
+import threading
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+
+# Components not needed when only the word vectors are used
+PIPELINE_COMPONENTS = [
+    "tok2vec",
+    "tagger",
+    "morphologizer",
+    "parser",
+    "senter",
+    "attribute_ruler",
+    "lemmatizer",
+    "ner",
+]
+
+_lock = threading.Lock()
+_nlp = None
+_details = {}
+
+
+def get_nlp():
+    """
+    Returns the spaCy pipeline shared by the whole process, loading it the
+    first time it is needed
+
+    The model is read from the SPACY_MODEL environment variable (defaults
+    to en_core_web_lg), and only its vectors are loaded when
+    SPACY_VECTORS_ONLY is set
+
+    ARGS:
+        None
+
+    RETURNS:
+        The spaCy pipeline
+    """
+    global _nlp
+
+    with _lock:
+        if _nlp is None:
+            # python -m spacy download en_core_web_lg
+            import spacy
+
+            model = os.environ.get("SPACY_MODEL", "en_core_web_lg")
+            vectors_only = os.environ.get("SPACY_VECTORS_ONLY", "").lower() in (
+                "1",
+                "true",
+                "yes",
+            )
+
+            start = time.time()
+            if vectors_only:
+                _nlp = spacy.load(model, exclude=PIPELINE_COMPONENTS)
+            else:
+                _nlp = spacy.load(model)
+
+            _details["model"] = model
+            _details["vectors_only"] = vectors_only
+            _details["load_time"] = time.time() - start
+
+        return _nlp
+
+
+def peak_rss() -> float:
+    """
+    Returns the peak resident memory of the process
+
+    ARGS:
+        None
+
+    RETURNS:
+        Peak resident memory in MB
+    """
+    if resource is None:
+        return 0.0
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Reported in bytes on macOS and in kilobytes elsewhere
+    if sys.platform == "darwin":
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+def report() -> dict:
+    """
+    Returns the details of the loaded model and the memory used
+
+    ARGS:
+        None
+
+    RETURNS:
+        Model name, whether only the vectors were loaded, load time in
+        seconds and peak resident memory in MB
+    """
+    details = dict(_details)
+    details["peak_rss"] = peak_rss()
+    return details
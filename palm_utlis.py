@@ -1,33 +1,214 @@
-import google.generativeai as palm
 import pprint
+import json
+import os
+import re
+import time
+import threading
 
-import spacy
+import numpy as np
 
-# python -m spacy download en_core_web_lg
+from metrics import metrics
+from nlp_service import get_nlp
+from ratelimit import get_limiter
 
-import nltk
 
-# nltk.download('stopwords')
-# nltk.download('punkt')
+# Version of the prompt templates, change it whenever a prompt is modified
+# so that the cached responses of the old prompts are not used
+PROMPT_VERSION = "2"
 
-from nltk.sentiment.vader import SentimentIntensityAnalyzer
-from nltk.corpus import stopwords
+# Possible status of an application (as written to the sheet)
+APP_STATUSES = ("APPLICATION", "REJECTION", "ASSESSMENT", "INTERVIEW", "OFFER")
+
+# Number of messages classified with one request, how many characters of
+# each message are sent and how many tokens each answer may take
+CLASSIFY_BATCH_SIZE = 8
+CLASSIFY_CHARS = 1500
+CLASSIFY_TOKENS_PER_MESSAGE = 8
+
+# One answer of the classification, e.g. "3: YES 0.92" (the label of the
+# message is sometimes repeated, e.g. "Message 3: YES 0.92")
+APP_ANSWER = re.compile(
+    r"^\W*(?:Message\W*)?(\d+)\W+(YES|NO)\b[^\d\n]*(\d*\.?\d+)?",
+    re.IGNORECASE | re.MULTILINE,
+)
+BARE_APP_ANSWER = re.compile(
+    r"^\W*(?:Message\W*)?(YES|NO)\b[^\d\n]*(\d*\.?\d+)?", re.IGNORECASE
+)
+
+# File remembering the model to use, and for how long (in seconds)
+MODEL_FILE = "palm_model.json"
+MODEL_FILE_TTL = 7 * 24 * 60 * 60
+
+
+class ModelError(Exception):
+    """
+    Raised when the model couldn't answer about a message (the API failed
+    or the answer was blocked), the message should be tried again later
+    """
 
 
 class Processor:
-    def __init__(self, API_KEY: str):
-        self.nlp = spacy.load("en_core_web_lg")
-        self.sia = SentimentIntensityAnalyzer()
+    def __init__(self, API_KEY: str, cache=None, palm=None):
+        self.api_key = API_KEY
+        self.cache = cache
+        self.limiter = get_limiter("palm")
+
+        # Heavy modules and objects are loaded the first time they are needed
+        # (palm can be given to use a local stand-in of the API)
+        self._palm = palm
+        self._lock = threading.Lock()
+        self._model = None
+        self._model_lock = threading.Lock()
+        self._status_vectors = None
+
+    @property
+    def nlp(self):
+        return get_nlp()
+
+    @property
+    def palm(self):
+        with self._lock:
+            if self._palm is None:
+                import google.generativeai as palm
+
+                palm.configure(api_key=self.api_key)
+                self._palm = palm
+            return self._palm
+
+    @property
+    def status_vectors(self) -> np.ndarray:
+        # Normalized vectors of the statuses, computed once
+        with self._lock:
+            if self._status_vectors is None:
+                vectors = np.array(
+                    [self.nlp.make_doc(s.lower()).vector for s in APP_STATUSES],
+                    dtype=np.float32,
+                ).reshape(len(APP_STATUSES), -1)
+                norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+                self._status_vectors = vectors / np.where(norms == 0, 1, norms)
+            return self._status_vectors
+
+    @property
+    def model(self) -> str:
+        # Only the first of the concurrent requests looks for the model
+        with self._model_lock:
+            if self._model is None:
+                self._model = self.get_model()
+            return self._model
+
+    def get_model(self) -> str:
+        """
+        Returns the name of the model to use, remembered in MODEL_FILE so
+        that the models are not listed on every run
+
+        PARAMS:
+            None
+
+        RETURNS:
+            The name of the model
+        """
+
+        if os.path.exists(MODEL_FILE):
+            try:
+                with open(MODEL_FILE, "r") as file:
+                    saved = json.load(file)
+                if time.time() - saved["time"] < MODEL_FILE_TTL:
+                    return saved["model"]
+            except (ValueError, KeyError, TypeError):
+                pass
 
         # PaLM
-        palm.configure(api_key=API_KEY)
         models = [
             m
-            for m in palm.list_models()
+            for m in self.limiter.call(lambda: list(self.palm.list_models()))
             if "generateText" in m.supported_generation_methods
         ]
+        model = models[0].name
+
+        with open(MODEL_FILE, "w") as file:
+            json.dump({"model": model, "time": time.time()}, file)
+
+        return model
+
+    def generate(
+        self,
+        task: str,
+        message: str,
+        prompt: str,
+        max_output_tokens: int = 800,
+        valid=None,
+    ) -> str:
+        """
+        Generates the model's response for the prompt, using the cache
+        when possible
+
+        PARAMS:
+            task: name of the prompt
+            message: the email message the prompt is about
+            prompt: the prompt
+            max_output_tokens: the maximum length of the response
+            valid: function checking the response, the responses it
+                   rejects are not cached (so they are asked again)
+
+        RETURNS:
+            The response of the model
+        """
+
+        result = self.cached(task, message)
+        if result is not None and (valid is None or valid(result)):
+            return result
+
+        result = self.complete(task, prompt, max_output_tokens)
+        if valid is None or valid(result):
+            self.save(task, message, result)
+        return result
+
+    def cached(self, task: str, message: str) -> str:
+        """
+        Returns the cached response of the prompt about the message
+
+        PARAMS:
+            task: name of the prompt
+            message: the email message the prompt is about
+
+        RETURNS:
+            The response, or None if it is not cached
+        """
+
+        if self.cache is None:
+            return None
+
+        result = self.cache.get(self.cache.make_key(self.model, PROMPT_VERSION, task, message))
+        metrics.incr("model.cache_hits" if result is not None else "model.cache_misses")
+        return result
+
+    def save(self, task: str, message: str, result: str) -> None:
+        if self.cache is not None and result is not None:
+            self.cache.set(self.cache.make_key(self.model, PROMPT_VERSION, task, message), result)
+
+    def complete(self, task: str, prompt: str, max_output_tokens: int = 800) -> str:
+        """
+        Sends the prompt to the model
+
+        PARAMS:
+            task: name of the prompt
+            prompt: the prompt
+            max_output_tokens: the maximum length of the response
 
-        self.model = models[0].name
+        RETURNS:
+            The response of the model
+        """
+
+        with metrics.timer(f"model.{task}"):
+            completion = self.limiter.call(
+                self.palm.generate_text,
+                model=self.model,
+                prompt=prompt,
+                temperature=0,
+                max_output_tokens=max_output_tokens,
+            )
+
+        return completion.result if completion is not None else None
 
     def is_app_mail(self, message: str) -> bool:
         """
@@ -39,33 +220,111 @@ class Processor:
 
         RETURNS:
             True if the message is regarding a job applicatoin that
-            the user applied to else False
+            the user applied to else False (ModelError is raised when
+            the model didn't answer)
         """
 
-        prompt = f"""
-        You can answer with only one word: 'Yes' or a 'No'.
+        answer = self.classify_apps([message])[0]
+        if answer is None:
+            raise ModelError("The model didn't classify the message")
+        return answer[0]
 
-        Is the following an email message from a company that the user has applied to (Say yes if it a email message regarding a job application confirmation, or any other update on the job application that the user has applied to):
+    def classify_apps(self, messages: list) -> list:
+        """
+        Checks which messages are regarding a job application that the
+        user has applied to, asking the model about up to
+        CLASSIFY_BATCH_SIZE messages at once
 
-        {message}
+        PARAMS:
+            messages: email messages
+
+        RETURNS:
+            For each message, True if it is regarding a job application
+            else False, and the confidence of the answer (None when the
+            model didn't answer)
         """
-        try:
-            completion = palm.generate_text(
-                model=self.model,
-                prompt=prompt,
-                temperature=0,
-                # The maximum length of the response
-                max_output_tokens=800,
-            )
 
-            sentiment_score = self.sia.polarity_scores(completion.result)
+        answers = [None] * len(messages)
+        pending = []
 
-            if sentiment_score["compound"] > 0:
-                return True
+        for i, message in enumerate(messages):
+            answer = self.parse_app_answers(self.cached("is_app", message), 1).get(1)
+            if answer is not None:
+                answers[i] = answer
             else:
-                return False
-        except AttributeError:
-            print(completion.result)
+                pending.append(i)
+
+        for start in range(0, len(pending), CLASSIFY_BATCH_SIZE):
+            batch = pending[start : start + CLASSIFY_BATCH_SIZE]
+
+            listed = "\n\n".join(
+                f"Message {n}:\n{messages[i][:CLASSIFY_CHARS]}"
+                for n, i in enumerate(batch, 1)
+            )
+            prompt = f"""
+        For each of the following email messages, decide if it is from a company that the user has applied to (YES if it is a email message regarding a job application confirmation, or any other update on the job application that the user has applied to, else NO).
+
+        Answer with exactly one line per message and nothing else, in the form:
+        <message number>: YES <confidence>
+        <message number>: NO <confidence>
+        where <confidence> is a number between 0 and 1.
+
+        {listed}
+        """
+
+            try:
+                result = self.complete(
+                    "is_app", prompt, CLASSIFY_TOKENS_PER_MESSAGE * len(batch)
+                )
+            except Exception as e:
+                print(f"An error occured at classify_apps: {e}")
+                continue
+
+            parsed = self.parse_app_answers(result, len(batch))
+            for n, i in enumerate(batch, 1):
+                answer = parsed.get(n)
+                if answer is None and len(batch) > 1:
+                    # Asked again alone when missing from the batch answer
+                    answer = self.classify_apps([messages[i]])[0]
+                elif answer is not None:
+                    self.save("is_app", messages[i], f"1: {'YES' if answer[0] else 'NO'} {answer[1]:.2f}")
+                answers[i] = answer
+
+        return answers
+
+    @staticmethod
+    def parse_app_answers(result: str, count: int) -> dict:
+        """
+        Parses the model's answers about which messages are regarding a
+        job application
+
+        PARAMS:
+            result: the answer of the model
+            count: number of messages asked about
+
+        RETURNS:
+            The answer (True or False, and the confidence) of each message
+            number that was answered, the confidence is 1 when the model
+            didn't give one
+        """
+
+        answers = {}
+        for match in APP_ANSWER.finditer(result or ""):
+            number = int(match.group(1))
+            if not 1 <= number <= count or number in answers:
+                continue
+
+            confidence = float(match.group(3)) if match.group(3) else 1.0
+            answers[number] = (match.group(2).upper() == "YES", min(confidence, 1.0))
+
+        # The number is often left out when there is only one message
+        if count == 1 and 1 not in answers:
+            match = BARE_APP_ANSWER.match(result or "")
+            if match:
+                confidence = float(match.group(2)) if match.group(2) else 1.0
+                answers[1] = (match.group(1).upper() == "YES", min(confidence, 1.0))
+
+        return answers
 
     def extract_company_name(
         self, message: str
@@ -88,15 +347,9 @@ class Processor:
         {message}
         """
 
-        completion = palm.generate_text(
-            model=self.model,
-            prompt=prompt,
-            temperature=0,
-            # the maximum length of the response
-            max_output_tokens=800,
-        )
+        result = self.generate("company", message, prompt, valid=self.valid_text)
 
-        return completion.result
+        return result
 
     def extract_role_name(self, message: str) -> str:
         """
@@ -117,17 +370,9 @@ class Processor:
         {message}
         """
 
-        print(message)
+        result = self.generate("role", message, prompt, valid=self.valid_text)
 
-        completion = palm.generate_text(
-            model=self.model,
-            prompt=prompt,
-            temperature=0,
-            # the maximum length of the response
-            max_output_tokens=800,
-        )
-
-        return completion.result
+        return result
 
     def extract_notes(self, message: str) -> str:
         """
@@ -149,15 +394,9 @@ class Processor:
         {message}
         """
 
-        completion = palm.generate_text(
-            model=self.model,
-            prompt=prompt,
-            temperature=0,
-            # the maximum length of the response
-            max_output_tokens=800,
-        )
+        result = self.generate("notes", message, prompt)
 
-        return completion.result
+        return result
 
     def extract_status(self, message: str) -> str:
         """
@@ -200,39 +439,55 @@ class Processor:
         {message}
         """
 
-        completion = palm.generate_text(
-            model=self.model,
-            prompt=prompt,
-            temperature=0,
-            # the maximum length of the response
-            max_output_tokens=800,
-        )
-
-        all_status = {
-            "application": 0.0,
-            "rejection": 0.0,
-            "offer": 0.0,
-            "assessment": 0.0,
-            "interview": 0.0,
-        }
-
-        # get the nouns from the result
-        result_nouns = " ".join(
-            [
-                token.lemma_
-                for token in self.nlp(completion.result)
-                if token.pos_ == "NOUN"
-            ]
-        )
+        result = self.generate("status", message, prompt, valid=self.valid_text)
 
-        if result_nouns.lower().strip() in all_status:
-            return result_nouns.upper().strip()
+        return self.map_statuses([result])[0]
 
-        for status in all_status:
-            all_status[status] = self.nlp(status).similarity(self.nlp(result_nouns))
+    def map_statuses(self, results: list) -> list:
+        """
+        Maps the model's answers about the status to the closest statuses
+
+        PARAMS:
+            results: the answers of the model
+
+        RETURNS:
+            The status of each answer
+        """
+
+        statuses = [None] * len(results)
+        pending = []
+
+        # Answers naming a single status don't need the model
+        for i, result in enumerate(results):
+            words = set(re.findall(r"[a-z]+", (result or "").lower()))
+            named = [s for s in APP_STATUSES if s.lower() in words]
+            if len(named) == 1:
+                statuses[i] = named[0]
+            else:
+                pending.append(i)
+
+        if not pending:
+            return statuses
+
+        # Get the nouns from the answers, pipelines without a tagger (vectors
+        # only) don't have the nouns
+        texts = [results[i] or "" for i in pending]
+        if self.nlp.has_pipe("tagger"):
+            texts = [
+                " ".join(token.lemma_ for token in doc if token.pos_ == "NOUN")
+                for doc in self.nlp.pipe(texts)
+            ]
 
-        res = max(all_status, key=all_status.get)
-        return res.upper().strip()
+        # Cosine similarity of every answer with every status at once
+        vectors = np.array(
+            [self.nlp.make_doc(text).vector for text in texts], dtype=np.float32
+        ).reshape(len(texts), -1)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        similarities = (vectors / np.where(norms == 0, 1, norms)) @ self.status_vectors.T
+
+        for i, best in zip(pending, similarities.argmax(axis=1)):
+            statuses[i] = APP_STATUSES[best]
+        return statuses
 
     def extract_info(self, message: str) -> dict:
         """
@@ -243,7 +498,8 @@ class Processor:
 
         RETURNS:
             Details from the message (company name, role name,
-            date, notes, and status of the application)
+            date, notes, and status of the application), ModelError is
+            raised when the model couldn't be asked
         """
 
         try:
@@ -259,5 +515,141 @@ class Processor:
             return info
 
         except Exception as e:
-            print(f"An error occured at extract_info: {e}")
+            raise ModelError(f"An error occured at extract_info: {e}") from e
+
+    def extract_structured(self, message: str, is_app: bool = None) -> dict:
+        """
+        Classifies the message and extracts all the details from it in a
+        single request. Fields missing or malformed in the model's answer
+        are extracted again with their own request.
+
+        PARAMS:
+            message: email message
+            is_app: whether the message is regarding a job application,
+                    when it was already classified (the model's answer
+                    about it is used otherwise)
+
+        RETURNS:
+            Details from the message in the same shape as extract_info,
+            or None if the message is not regarding a job application
+            (ModelError is raised when the model couldn't be asked)
+        """
+
+        prompt = f"""
+        Read the following email message and answer with a single JSON object and nothing else.
+        The JSON object must follow exactly this schema:
+
+        {{
+            "is_application": true or false,
+            "company": "name of the company that sent the email (only the name of the company)",
+            "role": "name of the role that the email and application is about (only the name of the role)",
+            "notes": "important details the receiver might need to know apart from the company and the role, 20 words max",
+            "status": "one of APPLICATION, REJECTION, ASSESSMENT, INTERVIEW, OFFER"
+        }}
+
+        *is_application is true if it is an email message regarding a job application confirmation, or any other update on the job application that the user has applied to.
+        *APPLICATION is for when the message is about confirmation of the application that was sent to the company.
+        *REJECTION is for when the message is about the application being rejected by the company
+        *ASSESSMENT is for when the message is about the company giving a assessment (online assessment) for the receipient to complete.
+        *INTERVIEW is for when the message is about an interview or a potential interview.
+        *OFFER is for when the message is about company accepting the application and offering the position.
+
+        The email message is:
+
+        {message}
+        """
+
+        try:
+            result = self.generate(
+                "structured", message, prompt, valid=self.parse_structured
+            )
+        except Exception as e:
+            raise ModelError(f"An error occured at extract_structured: {e}") from e
+        parsed = self.parse_structured(result)
+
+        # Classification
+        if is_app is None:
+            is_app = parsed.get("is_application")
+        if not isinstance(is_app, bool):
+            is_app = self.is_app_mail(message)
+        if not is_app:
             return None
+
+        try:
+            info = {}
+
+            info["company"] = self.valid_text(parsed.get("company"))
+            if info["company"] is None:
+                info["company"] = self.extract_company_name(message)
+
+            info["role"] = self.valid_text(parsed.get("role"))
+            if info["role"] is None:
+                info["role"] = self.extract_role_name(message)
+
+            info["date"] = "X"  # needs to get updated while processing the email
+
+            info["notes"] = self.valid_text(parsed.get("notes"), allow_empty=True)
+            if info["notes"] is None:
+                info["notes"] = self.extract_notes(message)
+
+            info["email"] = "X"  # needs to get updated while processing the email
+
+            status = self.valid_text(parsed.get("status"))
+            if status is not None and status.upper() in APP_STATUSES:
+                info["status"] = status.upper()
+            else:
+                info["status"] = self.extract_status(message)
+
+            return info
+
+        except Exception as e:
+            raise ModelError(f"An error occured at extract_structured: {e}") from e
+
+    @staticmethod
+    def parse_structured(result: str) -> dict:
+        """
+        Parses the JSON object from the model's answer
+
+        PARAMS:
+            result: the answer of the model
+
+        RETURNS:
+            The parsed object, or an empty dict if the answer is not valid JSON
+        """
+
+        if not result:
+            return {}
+
+        # The model sometimes wraps the object in a code block or some text
+        match = re.search(r"\{.*\}", result, re.DOTALL)
+        if not match:
+            return {}
+
+        try:
+            parsed = json.loads(match.group(0))
+        except ValueError:
+            return {}
+
+        return parsed if isinstance(parsed, dict) else {}
+
+    @staticmethod
+    def valid_text(value, allow_empty: bool = False) -> str:
+        """
+        Validates a text field of the parsed answer
+
+        PARAMS:
+            value: the value of the field
+            allow_empty: whether an empty string is a valid value
+
+        RETURNS:
+            The stripped text, or None if the value is missing or malformed
+        """
+
+        if not isinstance(value, str):
+            return None
+
+        value = value.strip()
+        if not value and not allow_empty:
+            return None
+
+        return value
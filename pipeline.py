@@ -0,0 +1,666 @@
+import time
+import asyncio
+import logging
+import threading
+import concurrent.futures
+
+from ledger import STAGES, DONE_STAGES
+from metrics import metrics
+from palm_utlis import CLASSIFY_BATCH_SIZE, ModelError
+from sheet_buffer import SheetWriteBuffer
+from sheet_index import SheetIndex
+
+
+# Marks the end of the items for a stage
+STOP = object()
+
+# Default number of concurrent workers for each stage
+DEFAULT_CONCURRENCY = {
+    "fetch": 8,
+    "classify": 4,
+    "extract": 8,
+    "reconcile": 4,
+    "write": 2,
+}
+
+# Stages where every email of a company goes to the same worker, so that
+# the emails of an application are handled one at a time without locks
+PARTITIONED_STAGES = {"reconcile", "write"}
+
+# Stages given the emails waiting in their queue together, up to a number
+BATCHED_STAGES = {"classify": CLASSIFY_BATCH_SIZE}
+
+# Number of times the model may fail on an email before it is given up on
+MAX_ATTEMPTS = 3
+
+# Minimum confidence of the classification for the extraction to trust it,
+# the extraction decides again for the less confident answers
+APP_CONFIDENCE = 0.7
+
+
+class Pipeline:
+    def __init__(
+        self,
+        gmail_worker,
+        sheets_worker,
+        processor,
+        sheet_id: str,
+        sheet_name: str,
+        concurrency: dict = None,
+        queue_size: int = 32,
+        batch_size: int = 1,
+        prefilter=None,
+        classifier=None,
+        flush_size: int = 200,
+        flush_interval: float = 60,
+        ledger=None,
+        read_batch_size: int = 1000,
+    ):
+        """
+        Initializes the Pipeline class that processes the emails through the
+        fetch -> classify -> extract -> reconcile -> write stages
+
+        ARGS:
+            gmail_worker: GmailWorker used to read the emails
+            sheets_worker: SheetsWorker used to update the sheet
+            processor: Processor used to extract the details
+            sheet_id: Id of the google sheet
+            sheet_name: Name of the google sheet
+            concurrency: Number of concurrent workers for each stage
+            queue_size: Maximum number of items waiting between two stages
+            batch_size: Number of emails fetched with one batch request
+                        (1 fetches the emails one by one)
+            prefilter: Function that decides from the headers of an email if
+                       it should be fetched completely (used with batches)
+            classifier: HeuristicClassifier used to skip the emails that are
+                        obviously not regarding a job application
+            flush_size: Number of buffered updates that triggers a write
+            flush_interval: Seconds after which buffered updates are written
+            ledger: Ledger recording the stage of each email, used to skip
+                    or resume the emails seen by previous runs
+            read_batch_size: Number of written emails that triggers marking
+                             them read
+
+        RETURNS:
+            None
+        """
+        self.gmail_worker = gmail_worker
+        self.sheets_worker = sheets_worker
+        self.processor = processor
+        self.sheet_id = sheet_id
+        self.sheet_name = sheet_name
+
+        self.concurrency = dict(DEFAULT_CONCURRENCY)
+        self.concurrency.update(concurrency or {})
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.prefilter = prefilter
+        self.classifier = classifier
+        self.ledger = ledger
+
+        # Updates of the sheet are written together
+        self.buffer = SheetWriteBuffer(
+            sheets_worker, sheet_id, flush_size, flush_interval
+        )
+
+        # Emails whose update is written, marked read together
+        self.read_batch_size = read_batch_size
+        self._unread = []
+        self._unread_lock = threading.Lock()
+        self._mark_lock = threading.Lock()
+
+        self.app_categories = {
+            "application": 0,
+            "assessment": 0,
+            "interview": 0,
+            "offer": 0,
+            "rejection": 0,
+        }
+        self._categories_lock = threading.Lock()
+
+        # When the processing of each email started
+        self._started = {}
+
+    def fetch(self, email: dict) -> dict:
+        """
+        Reads the email
+
+        ARGS:
+            email: The email to fetch (as listed by GmailWorker.get_messages)
+
+        RETURNS:
+            Details of the email, or None if it couldn't be read
+        """
+        details = self.gmail_worker.get_mail_details(email)
+
+        if not details:
+            # Inform the user
+            print(f"This email couldn't be read: {email['id']}\n")
+            return None
+
+        self.record(details["id"], "fetched", details, details["message"])
+        return details
+
+    def fetch_batch(self, emails: list) -> list:
+        """
+        Reads the emails with batch requests
+
+        ARGS:
+            emails: The emails to fetch (as listed by GmailWorker.get_messages)
+
+        RETURNS:
+            Details of the emails that could be read
+        """
+        prefilter = self._prefilter if self.prefilter else None
+        mails = self.gmail_worker.get_mail_details_batch(emails, prefilter)
+
+        for details in mails:
+            self.record(details["id"], "fetched", details, details["message"])
+        return mails
+
+    def _prefilter(self, headers: dict) -> bool:
+        if self.prefilter(headers):
+            return True
+
+        self.record(headers["id"], "skipped")
+        return False
+
+    def classify(self, batch: list) -> list:
+        """
+        Filters out the emails that can not be processed or are not
+        regarding a job application, asking the model about many emails
+        with one request
+
+        ARGS:
+            batch: Details of the emails
+
+        RETURNS:
+            Details of the emails that should be processed
+        """
+        pending = []
+        for details in batch:
+            if details["message"] == None:
+                # Inform the user
+                print(
+                    f'Email couldn\'t be read:\nemail id: {details["id"]}\nsender: {details["sender"]}\n'
+                )
+                continue
+
+            # Skip the model for the obviously irrelevant emails
+            if self.classifier is not None and self.classifier.is_irrelevant(details):
+                self.record(details["id"], "skipped")
+                continue
+
+            pending.append(details)
+
+        if not pending:
+            return []
+
+        answers = self.processor.classify_apps([d["message"] for d in pending])
+
+        relevant = []
+        for details, answer in zip(pending, answers):
+            if answer is None:
+                self.retry_later(details["id"], "the model didn't answer")
+                continue
+
+            is_app, confidence = answer
+            if not is_app and confidence >= APP_CONFIDENCE:
+                self.record(details["id"], "skipped")
+                continue
+
+            # Unsure answers are decided by the extraction
+            details["is_app"] = True if confidence >= APP_CONFIDENCE else None
+            self.record(details["id"], "classified", details)
+            relevant.append(details)
+
+        return relevant
+
+    def extract(self, details: dict) -> dict:
+        """
+        Extracts the application details from the email
+
+        ARGS:
+            details: Details of the email
+
+        RETURNS:
+            The email details and the extracted info, or None if the email
+            is not regarding a job application
+        """
+        # Check if the email is job application related and get the details
+        try:
+            info = self.processor.extract_structured(
+                details["message"], details.get("is_app")
+            )
+        except ModelError as e:
+            self.retry_later(details["id"], f"the model didn't answer ({e})")
+            return None
+
+        if not info:
+            self.record(details["id"], "skipped")
+            return None
+
+        # The company and role decide where the application is written
+        for field in ("company", "role"):
+            if not isinstance(info.get(field), str) or not info[field].strip():
+                self.retry_later(details["id"], f"the model didn't give the {field}")
+                return None
+            info[field] = info[field].strip()
+
+        # Include meta data
+        info["date"] = details["date"]
+        info[
+            "email"
+        ] = f"https://mail.google.com/mail/u/{details['receiver'].strip()}/#inbox/{details['id'].strip()}"
+
+        item = {"details": details, "info": info}
+        self.record(details["id"], "extracted", item)
+        return item
+
+    def reconcile(self, item: dict) -> dict:
+        """
+        Finds the range of the sheet the application should be written to
+
+        ARGS:
+            item: The email details and the extracted info
+
+        RETURNS:
+            The item with the range to write to
+        """
+        info = item["info"]
+
+        # Check existing range
+        prev_range = self.sheets_worker.get_existing_range(
+            info["company"], info["role"]
+        )
+
+        # Create new entry if no previous entry
+        if prev_range == None:
+            item["range"] = self.sheets_worker.reserve_range()
+            item["new"] = True
+
+            # Later emails about the same application use the new entry
+            self.sheets_worker.add_to_index(info["company"], info["role"], item["range"])
+        else:
+            item["range"] = prev_range
+            item["new"] = False
+
+        return item
+
+    def write(self, item: dict) -> dict:
+        """
+        Buffers the update of the sheet, the email is marked read once the
+        update is written
+
+        ARGS:
+            item: The email details, the extracted info and the range
+
+        RETURNS:
+            The item
+        """
+        details, info = item["details"], item["info"]
+
+        # Prepare the data to update the sheets
+        values = list(info.values())
+
+        def mark_read():
+            self.record(details["id"], "written")
+            self.queue_read(details["id"].strip())
+
+        # Dont update if the sheet has a more recent email, the date of the
+        # most recent email of each row is kept in the index
+        if self.sheets_worker.claim_range(item["range"], info["date"]):
+            self.buffer.add(item["range"], values, info["date"], mark_read)
+        else:
+            # Nothing to write, the sheet has a more recent email
+            self.record(details["id"], "written")
+
+        # Update the count
+        self.count(info["status"])
+
+        return item
+
+    def flush(self) -> None:
+        """
+        Writes the pending updates to the sheet, then marks their emails
+        read
+
+        ARGS:
+            None
+
+        RETURNS:
+            None
+        """
+        self.buffer.flush()
+        self.flush_read()
+
+    def queue_read(self, msg_id: str) -> None:
+        """
+        Adds an email to be marked read, called once its update is written
+        to the sheet so that it is never marked read before
+
+        ARGS:
+            msg_id: Id of the email
+
+        RETURNS:
+            None
+        """
+        with self._unread_lock:
+            self._unread.append(msg_id)
+            should_flush = len(self._unread) >= self.read_batch_size
+
+        if should_flush:
+            self.flush_read()
+
+    def flush_read(self) -> None:
+        """
+        Marks the queued emails read with batchModify calls, the ones that
+        failed are kept for the next flush
+
+        ARGS:
+            None
+
+        RETURNS:
+            None
+        """
+        with self._mark_lock:
+            with self._unread_lock:
+                ids, self._unread = self._unread, []
+
+            if not ids:
+                return
+
+            failed = self.gmail_worker.mark_read(ids)
+
+            if failed:
+                with self._unread_lock:
+                    self._unread = failed + self._unread
+
+    def retry_later(self, msg_id: str, reason: str) -> None:
+        """
+        Leaves the email at its last stage so that the next run tries it
+        again, or gives up on it after MAX_ATTEMPTS
+
+        ARGS:
+            msg_id: Id of the email
+            reason: Why the email couldn't be processed
+
+        RETURNS:
+            None
+        """
+        metrics.incr("errors.model")
+
+        if self.ledger is not None and self.ledger.attempt(msg_id) >= MAX_ATTEMPTS:
+            print(f"This email failed {MAX_ATTEMPTS} times and won't be retried, {reason}: {msg_id}\n")
+            self.record(msg_id, "failed")
+            return
+
+        print(f"This email will be retried, {reason}: {msg_id}\n")
+
+    def record(self, msg_id: str, stage: str, payload=None, message: str = None) -> None:
+        """
+        Records the stage the email went through in the ledger, if any
+
+        ARGS:
+            msg_id: Id of the email
+            stage: The stage
+            payload: What is needed to resume from the stage
+            message: The email message
+
+        RETURNS:
+            None
+        """
+        metrics.incr(f"emails.{stage}")
+        if stage in DONE_STAGES and msg_id in self._started:
+            metrics.observe("email.total", time.perf_counter() - self._started.pop(msg_id))
+
+        if self.ledger is not None:
+            self.ledger.record(msg_id, stage, payload, message)
+
+    def resume_point(self, email: dict) -> tuple:
+        """
+        Returns where the processing of the email should start from,
+        according to the ledger
+
+        ARGS:
+            email: The email (as listed by GmailWorker.get_messages)
+
+        RETURNS:
+            The index of the stage to start from and its input, or None if
+            the email was completely processed already
+        """
+        if self.ledger is None:
+            self._started[email["id"]] = time.perf_counter()
+            return 0, email
+
+        entry = self.ledger.get(email["id"])
+        if entry is not None and entry["stage"] in DONE_STAGES:
+            self.ledger.count(self.ledger.skipped, entry["stage"])
+            return None
+
+        self._started[email["id"]] = time.perf_counter()
+        if entry is None:
+            return 0, email
+
+        if entry["payload"] is None:
+            return 0, email
+
+        self.ledger.count(self.ledger.resumed, entry["stage"])
+        return STAGES.index(entry["stage"]) + 1, entry["payload"]
+
+    def count(self, status: str) -> None:
+        """
+        Acknowledges an update for the status
+
+        ARGS:
+            status: Status of the application
+
+        RETURNS:
+            None
+        """
+        with self._categories_lock:
+            self.app_categories[status.lower().strip()] += 1
+
+    @staticmethod
+    def partition(item: dict) -> int:
+        """
+        Returns the key deciding which worker of a partitioned stage handles
+        the item
+
+        ARGS:
+            item: The email details and the extracted info
+
+        RETURNS:
+            The key, the same for every email of a company (roles are
+            matched by similarity within a company)
+        """
+        return hash(SheetIndex.normalize(item["info"]["company"]))
+
+    def run(self, emails) -> dict:
+        """
+        Processes all the emails concurrently
+
+        ARGS:
+            emails: The emails to process
+
+        RETURNS:
+            Count of the updates made for each category
+        """
+        try:
+            asyncio.run(self._run(emails))
+        finally:
+            self.flush()
+
+            # Give back the reserved rows that were not used
+            self.sheets_worker.state.release()
+
+            # Remember which cached responses were used
+            if self.processor.cache is not None:
+                self.processor.cache.flush()
+        return self.app_categories
+
+    async def _run(self, emails) -> None:
+        stages = [
+            ("fetch", self.fetch_batch if self.batch_size > 1 else self.fetch),
+            ("classify", self.classify),
+            ("extract", self.extract),
+            ("reconcile", self.reconcile),
+            ("write", self.write),
+        ]
+
+        # Blocking calls are run in threads, one per worker
+        loop = asyncio.get_running_loop()
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=sum(self.concurrency[name] for name, _ in stages)
+        )
+        loop.set_default_executor(executor)
+
+        # Partitioned stages have a queue for each worker
+        queues = [
+            [
+                asyncio.Queue(self.queue_size)
+                for _ in range(self.concurrency[name] if name in PARTITIONED_STAGES else 1)
+            ]
+            for name, _ in stages
+        ]
+        tasks = [asyncio.create_task(self._feed(emails, queues))]
+
+        for i, (name, func) in enumerate(stages):
+            outboxes, next_workers = None, 0
+            if i + 1 < len(stages):
+                outboxes = queues[i + 1]
+                next_workers = self.concurrency[stages[i + 1][0]]
+
+            tasks.append(
+                asyncio.create_task(
+                    self._stage(
+                        name,
+                        func,
+                        queues[i],
+                        outboxes,
+                        self.concurrency[name],
+                        next_workers,
+                        BATCHED_STAGES.get(name, 1),
+                    )
+                )
+            )
+
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            executor.shutdown(wait=True)
+
+    async def _put(self, queues: list, item) -> None:
+        if len(queues) == 1:
+            await queues[0].put(item)
+            return
+
+        try:
+            key = self.partition(item)
+        except Exception as e:
+            # Only this email is dropped, it is left at its last stage
+            logging.error(f"An email couldn't be passed on: {e}")
+            metrics.incr("errors.partition")
+            return
+        await queues[key % len(queues)].put(item)
+
+    async def _stop(self, queues: list, workers: int) -> None:
+        # One STOP for each worker, in the queue the worker reads
+        for i in range(workers):
+            await queues[i % len(queues)].put(STOP)
+
+    async def _feed(self, emails, queues: list) -> None:
+        outbox = queues[0][0]
+        batch = []
+
+        async for email in self._iterate(emails):
+            start = self.resume_point(email)
+            if start is None:
+                continue
+
+            # Emails seen by a previous run continue from their last stage
+            index, item = start
+            if index > 0:
+                await self._put(queues[index], item)
+            elif self.batch_size > 1:
+                batch.append(email)
+                if len(batch) == self.batch_size:
+                    await outbox.put(batch)
+                    batch = []
+            else:
+                await outbox.put(email)
+
+        if batch:
+            await outbox.put(batch)
+
+        await self._stop(queues[0], self.concurrency["fetch"])
+
+    async def _iterate(self, emails):
+        # Lists are already in memory, anything else (like the generator of
+        # GmailWorker.iter_messages) may block while the next page is listed
+        if isinstance(emails, (list, tuple)):
+            for email in emails:
+                yield email
+            return
+
+        emails = iter(emails)
+        while True:
+            email = await asyncio.to_thread(next, emails, STOP)
+            if email is STOP:
+                return
+            yield email
+
+    async def _stage(
+        self,
+        name: str,
+        func,
+        inboxes: list,
+        outboxes: list,
+        workers: int,
+        next_workers: int,
+        batch_size: int = 1,
+    ) -> None:
+        async def worker(inbox: asyncio.Queue):
+            stopped = False
+            while not stopped:
+                item = await inbox.get()
+                if item is STOP:
+                    return
+
+                # Batched stages also take the items already waiting
+                if batch_size > 1:
+                    item = [item]
+                    while len(item) < batch_size and not inbox.empty():
+                        extra = inbox.get_nowait()
+                        if extra is STOP:
+                            stopped = True
+                            break
+                        item.append(extra)
+
+                start = time.perf_counter()
+                try:
+                    result = await asyncio.to_thread(func, item)
+                except Exception as e:
+                    logging.error(f"An error occured at {name}: {e}")
+                    metrics.incr(f"errors.{name}")
+                    continue
+                finally:
+                    metrics.observe(f"stage.{name}", time.perf_counter() - start)
+
+                if result is None or outboxes is None:
+                    continue
+
+                # Stages working on batches pass on each item separately
+                if isinstance(result, list):
+                    for r in result:
+                        await self._put(outboxes, r)
+                else:
+                    await self._put(outboxes, result)
+
+        await asyncio.gather(
+            *(worker(inboxes[i % len(inboxes)]) for i in range(workers))
+        )
+
+        # Let the workers of the next stage know there is nothing left
+        if outboxes is not None:
+            await self._stop(outboxes, next_workers)
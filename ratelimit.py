@@ -0,0 +1,275 @@
+import time
+import random
+import socket
+import logging
+import threading
+
+from metrics import metrics
+
+
+# Requests per second, burst size and maximum concurrency of each API,
+# kept just under the default per user quotas
+LIMITS = {
+    # 250 quota units per second, messages.get costs 5 units
+    "gmail": {"rate": 40, "burst": 50, "concurrency": 16},
+    # 60 read and 60 write requests per minute
+    "sheets": {"rate": 1, "burst": 10, "concurrency": 4},
+    # 90 requests per minute
+    "palm": {"rate": 1.4, "burst": 5, "concurrency": 8},
+}
+
+# Status codes worth retrying
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+# Status codes meaning the quota is exceeded
+THROTTLE_STATUS = {429}
+
+
+def error_status(error: Exception) -> int:
+    """
+    Returns the HTTP status code of an error raised by a Google client
+
+    ARGS:
+        error: The error
+
+    RETURNS:
+        The status code, or None if the error has none
+    """
+    # googleapiclient.errors.HttpError
+    resp = getattr(error, "resp", None)
+    if resp is not None and getattr(resp, "status", None) is not None:
+        return int(resp.status)
+
+    # google.api_core.exceptions.GoogleAPICallError
+    code = getattr(error, "code", None)
+    if isinstance(code, int):
+        return code
+
+    return None
+
+
+def is_retryable(error: Exception) -> bool:
+    """
+    Checks if the request that raised the error should be retried
+
+    ARGS:
+        error: The error
+
+    RETURNS:
+        True if the error is temporary (quota, server or network error)
+    """
+    if isinstance(error, (socket.timeout, ConnectionError, TimeoutError)):
+        return True
+    return error_status(error) in RETRY_STATUS
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        """
+        Initializes the TokenBucket class that limits the rate of requests
+
+        ARGS:
+            rate: Requests allowed per second
+            burst: Maximum number of requests allowed at once
+
+        RETURNS:
+            None
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1) -> None:
+        """
+        Waits until the tokens are available and takes them
+
+        ARGS:
+            tokens: Number of tokens (requests) needed
+
+        RETURNS:
+            None
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+
+                # Requests costing more than the burst only wait for a full bucket
+                needed = min(tokens, self.burst)
+                if self.tokens >= needed:
+                    self.tokens -= tokens
+                    return
+                wait = (needed - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+class RateLimiter:
+    def __init__(
+        self,
+        name: str,
+        rate: float,
+        burst: int,
+        concurrency: int,
+        retries: int = 6,
+        base_delay: float = 1,
+        max_delay: float = 64,
+    ):
+        """
+        Initializes the RateLimiter class that sends the requests of an API
+        under its quota: the rate is limited by a token bucket and the number
+        of concurrent requests adapts to the errors (AIMD), and temporary
+        errors are retried with jittered exponential backoff
+
+        ARGS:
+            name: Name of the API
+            rate: Requests allowed per second
+            burst: Maximum number of requests allowed at once
+            concurrency: Maximum number of concurrent requests
+            retries: Maximum number of retries of a request
+            base_delay: Seconds to wait before the first retry
+            max_delay: Maximum seconds to wait between two retries
+
+        RETURNS:
+            None
+        """
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.max_concurrency = concurrency
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        # Current concurrency limit, halved when throttled and slowly raised
+        self.limit = float(concurrency)
+        self.active = 0
+        self._cond = threading.Condition()
+        self._last_decrease = 0
+
+        self.calls = 0
+        self.retried = 0
+        self.throttled = 0
+
+    def call(self, func, *args, cost: float = 1, **kwargs):
+        """
+        Calls the function under the limits of the API, retrying it on
+        temporary errors
+
+        ARGS:
+            func: Function sending the request
+            args: Arguments of the function
+            cost: Number of requests the call counts for
+            kwargs: Keyword arguments of the function
+
+        RETURNS:
+            What the function returns
+        """
+        attempt = 0
+        while True:
+            self.bucket.acquire(cost)
+            self._enter()
+            start = time.perf_counter()
+            try:
+                self.calls += 1
+                metrics.incr(f"api.{self.name}.calls")
+                result = func(*args, **kwargs)
+            except Exception as error:
+                self._exit()
+                metrics.observe(f"api.{self.name}", time.perf_counter() - start)
+                if not is_retryable(error) or attempt >= self.retries:
+                    raise
+
+                self.failure(error)
+                delay = self.backoff(attempt)
+                logging.warning(
+                    f"{self.name} request failed ({error}), retrying in {delay:.1f} seconds"
+                )
+                time.sleep(delay)
+                attempt += 1
+                continue
+
+            self._exit()
+            metrics.observe(f"api.{self.name}", time.perf_counter() - start)
+            self.success()
+            return result
+
+    def execute(self, request, cost: float = 1):
+        """
+        Executes a request of a Google API client under the limits of the API
+
+        ARGS:
+            request: The request (HttpRequest or BatchHttpRequest)
+            cost: Number of requests the call counts for
+
+        RETURNS:
+            The response
+        """
+        return self.call(request.execute, cost=cost)
+
+    def backoff(self, attempt: int) -> float:
+        """
+        Returns the delay before retrying (full jitter)
+
+        ARGS:
+            attempt: Number of the retry, starting at 0
+
+        RETURNS:
+            Seconds to wait
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    def success(self) -> None:
+        with self._cond:
+            # Additive increase, about one more request per full window
+            self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+    def failure(self, error: Exception) -> None:
+        metrics.incr(f"api.{self.name}.retries")
+        with self._cond:
+            self.retried += 1
+            if error_status(error) in THROTTLE_STATUS:
+                self.throttled += 1
+                metrics.incr(f"api.{self.name}.throttled")
+
+            # Multiplicative decrease, at most once a second for a burst of errors
+            now = time.monotonic()
+            if now - self._last_decrease >= 1:
+                self.limit = max(1.0, self.limit / 2)
+                self._last_decrease = now
+
+    def _enter(self) -> None:
+        with self._cond:
+            while self.active >= int(self.limit):
+                self._cond.wait()
+            self.active += 1
+
+    def _exit(self) -> None:
+        with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(name: str) -> RateLimiter:
+    """
+    Returns the rate limiter of the API shared by the whole process
+
+    ARGS:
+        name: Name of the API (gmail, sheets or palm)
+
+    RETURNS:
+        The rate limiter
+    """
+    with _limiters_lock:
+        if name not in _limiters:
+            _limiters[name] = RateLimiter(name, **LIMITS[name])
+        return _limiters[name]
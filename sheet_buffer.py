@@ -0,0 +1,158 @@
+import time
+import threading
+import datetime
+
+from email.utils import parsedate_to_datetime
+
+
+def parse_date(date: str) -> datetime.datetime:
+    """
+    Parses the date of an email (RFC 2822)
+
+    ARGS:
+        date: Date header of the email
+
+    RETURNS:
+        The date (timezone aware), or None if it can't be parsed
+    """
+    try:
+        parsed = parsedate_to_datetime(date.strip())
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed
+
+
+class SheetWriteBuffer:
+    def __init__(
+        self,
+        sheets_worker,
+        spreadsheet_id: str,
+        max_size: int = 200,
+        max_delay: float = 60,
+    ):
+        """
+        Initializes the SheetWriteBuffer class that collects the updates of
+        the sheet and writes them with a single batchUpdate call
+
+        ARGS:
+            sheets_worker: SheetsWorker used to write to the sheet
+            spreadsheet_id: Id of the google sheet
+            max_size: Number of pending ranges that triggers a flush
+            max_delay: Seconds after the first pending update that trigger
+                       a flush
+
+        RETURNS:
+            None
+        """
+        self.sheets_worker = sheets_worker
+        self.spreadsheet_id = spreadsheet_id
+        self.max_size = max_size
+        self.max_delay = max_delay
+
+        # Pending values, date and callbacks by range
+        self.pending = {}
+        self.first_pending = None
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def add(self, range_name: str, values: list, date: str, on_flush=None) -> bool:
+        """
+        Adds an update of the sheet, keeping only the most recent email
+        for each range
+
+        ARGS:
+            range_name: The range to update
+            values: The values to update the range with
+            date: Date of the email the values are from
+            on_flush: Function called once the update is written (or
+                      replaced by a more recent one that is written)
+
+        RETURNS:
+            True if the update is the most recent one for the range
+        """
+        callbacks = [on_flush] if on_flush else []
+        parsed = parse_date(date)
+
+        with self._lock:
+            if range_name in self.pending:
+                prev = self.pending[range_name]
+                callbacks = prev["callbacks"] + callbacks
+                is_newest = (
+                    parsed is None or prev["date"] is None or parsed >= prev["date"]
+                )
+                if not is_newest:
+                    prev["callbacks"] = callbacks
+                    return False
+
+            self.pending[range_name] = {
+                "values": values,
+                "date": parsed,
+                "callbacks": callbacks,
+            }
+            if self.first_pending is None:
+                self.first_pending = time.monotonic()
+
+            should_flush = len(self.pending) >= self.max_size or (
+                time.monotonic() - self.first_pending >= self.max_delay
+            )
+
+        if should_flush:
+            self.flush()
+        return True
+
+    def flush(self) -> None:
+        """
+        Writes all the pending updates with one batchUpdate call
+
+        ARGS:
+            None
+
+        RETURNS:
+            None
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending, self.pending = self.pending, {}
+                self.first_pending = None
+
+            if not pending:
+                return
+
+            data = [
+                {"range": range_name, "values": [update["values"]]}
+                for range_name, update in pending.items()
+            ]
+            try:
+                result = self.sheets_worker.batch_update(
+                    self.spreadsheet_id, data, "USER_ENTERED"
+                )
+            except Exception as e:
+                result = e
+
+            if result is None or isinstance(result, Exception):
+                # Keep the updates for the next flush
+                with self._lock:
+                    for range_name, update in pending.items():
+                        newer = self.pending.get(range_name)
+                        if newer is None:
+                            self.pending[range_name] = update
+                        elif (
+                            update["date"] is not None
+                            and newer["date"] is not None
+                            and update["date"] > newer["date"]
+                        ):
+                            update["callbacks"] += newer["callbacks"]
+                            self.pending[range_name] = update
+                        else:
+                            newer["callbacks"] += update["callbacks"]
+                    if self.first_pending is None:
+                        self.first_pending = time.monotonic()
+                return
+
+            for update in pending.values():
+                for callback in update["callbacks"]:
+                    callback()
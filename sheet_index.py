@@ -0,0 +1,167 @@
+import re
+import threading
+
+import numpy as np
+
+from sheet_buffer import parse_date
+
+
+class SheetIndex:
+    def __init__(self, nlp, threshold: float = 0.8):
+        """
+        Initializes the SheetIndex class, an in memory index of the
+        applications in the sheet by company and role
+
+        ARGS:
+            nlp: spaCy pipeline used to get the vectors of the roles
+            threshold: Minimum similarity for two roles to be the same
+
+        RETURNS:
+            None
+        """
+        self.nlp = nlp
+        self.threshold = threshold
+
+        # Positions of the rows of each company
+        self.companies = {}
+        self.rows = []
+        self.roles = []
+
+        # Date of the most recent email written to each row
+        self.dates = {}
+
+        # Normalized role vectors, one per row (grown by doubling)
+        self.vectors = np.zeros((16, nlp.vocab.vectors_length or 1), dtype=np.float32)
+
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return re.sub(r"\s+", " ", text.lower()).strip()
+
+    def load(self, values: list, start_row: int = 2) -> None:
+        """
+        Adds the rows of the sheet to the index
+
+        ARGS:
+            values: Company, role and date of each row
+            start_row: Number of the first row in the sheet
+
+        RETURNS:
+            None
+        """
+        rows = [
+            (
+                start_row + i,
+                row[0],
+                row[1] if len(row) > 1 else "",
+                row[2] if len(row) > 2 else "",
+            )
+            for i, row in enumerate(values)
+            if row and row[0].strip()
+        ]
+        # Only the word vectors are needed, not the whole pipeline
+        docs = (self.nlp.make_doc(self.normalize(role)) for _, _, role, _ in rows)
+
+        for (row, company, role, date), doc in zip(rows, docs):
+            self._add(company, role, row, doc.vector, parse_date(date))
+
+    def add(self, company: str, role: str, row: int, date: str = None) -> None:
+        """
+        Adds a row to the index
+
+        ARGS:
+            company: Name of the company
+            role: Name of the role
+            row: Number of the row in the sheet
+            date: Date of the email written to the row, if any
+
+        RETURNS:
+            None
+        """
+        self._add(
+            company,
+            role,
+            row,
+            self.nlp.make_doc(self.normalize(role)).vector,
+            parse_date(date) if date else None,
+        )
+
+    def _add(self, company: str, role: str, row: int, vector, date=None) -> None:
+        if len(vector) != self.vectors.shape[1]:
+            # Pipelines without vectors only match the roles exactly
+            vector = np.zeros(self.vectors.shape[1], dtype=np.float32)
+
+        norm = np.linalg.norm(vector)
+        if norm:
+            vector = vector / norm
+
+        with self._lock:
+            position = len(self.rows)
+            if position == len(self.vectors):
+                self.vectors = np.concatenate([self.vectors, np.zeros_like(self.vectors)])
+
+            self.vectors[position] = vector
+            self.rows.append(row)
+            self.roles.append(self.normalize(role))
+            self.companies.setdefault(self.normalize(company), []).append(position)
+            if date is not None:
+                self.dates[row] = date
+
+    def claim(self, row: int, date: str) -> bool:
+        """
+        Records the email as the most recent one of the row, unless the row
+        already has a more recent email
+
+        ARGS:
+            row: Number of the row in the sheet
+            date: Date of the email (RFC 2822)
+
+        RETURNS:
+            True if the email is the most recent one and should be written
+        """
+        parsed = parse_date(date) if date else None
+
+        # Emails without a date are written, like before the index had dates
+        if parsed is None:
+            return True
+
+        with self._lock:
+            prev = self.dates.get(row)
+            if prev is not None and prev > parsed:
+                return False
+            self.dates[row] = parsed
+            return True
+
+    def find(self, company: str, role: str) -> int:
+        """
+        Returns the row of the application
+
+        ARGS:
+            company: Name of the company
+            role: Name of the role
+
+        RETURNS:
+            Number of the row in the sheet, or None if the application
+            is not in the index
+        """
+        with self._lock:
+            positions = list(self.companies.get(self.normalize(company), []))
+        if not positions:
+            return None
+
+        role = self.normalize(role)
+        for position in positions:
+            if self.roles[position] == role:
+                return self.rows[position]
+
+        vector = self.nlp.make_doc(role).vector
+        norm = np.linalg.norm(vector)
+        if not norm:
+            return None
+
+        similarities = self.vectors[positions] @ (vector / norm)
+        best = int(np.argmax(similarities))
+        if similarities[best] > self.threshold:
+            return self.rows[positions[best]]
+        return None
@@ -0,0 +1,182 @@
+import os
+import re
+import sqlite3
+import threading
+
+
+class StateStore:
+    def __init__(self, path: str = "app_state.sqlite3", block_size: int = 8):
+        """
+        Initializes the StateStore class that keeps the local state of the
+        application (sheet details, next free row, ...) in a SQLite file
+        shared safely by concurrent processes
+
+        ARGS:
+            path: Path of the SQLite file
+            block_size: Number of rows reserved at once, the rows of a block
+                        are handed out from memory
+
+        RETURNS:
+            None
+        """
+        self.path = path
+        self.block_size = block_size
+
+        self._lock = threading.Lock()
+        self._cache = {}
+
+        # Rows reserved by this process that are not used yet
+        self._block_next = None
+        self._block_end = None
+
+        self._conn = sqlite3.connect(
+            path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+        )
+
+    def get(self, key: str, default: str = None) -> str:
+        """
+        Returns the value of the key
+
+        ARGS:
+            key: The key
+            default: Value returned when the key is not set
+
+        RETURNS:
+            The value of the key
+        """
+        with self._lock:
+            if key not in self._cache:
+                row = self._conn.execute(
+                    "SELECT value FROM state WHERE key = ?", (key,)
+                ).fetchone()
+                if row is None:
+                    return default
+                self._cache[key] = row[0]
+            return self._cache[key]
+
+    def set(self, key: str, value) -> None:
+        """
+        Sets the value of the key
+
+        ARGS:
+            key: The key
+            value: The value
+
+        RETURNS:
+            None
+        """
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO state VALUES (?, ?)", (key, str(value))
+            )
+            self._cache[key] = str(value)
+
+    def reserve_row(self) -> int:
+        """
+        Reserves the next free row of the sheet, no other process or
+        thread gets the same row
+
+        ARGS:
+            None
+
+        RETURNS:
+            The number of the reserved row
+        """
+        with self._lock:
+            if self._block_next is None or self._block_next >= self._block_end:
+                self._block_next = self._allocate(self.block_size)
+                self._block_end = self._block_next + self.block_size
+
+            row = self._block_next
+            self._block_next += 1
+            return row
+
+    def release(self) -> None:
+        """
+        Gives back the rows of the current block that were not used, if no
+        other process reserved rows after them
+
+        ARGS:
+            None
+
+        RETURNS:
+            None
+        """
+        with self._lock:
+            if self._block_next is None or self._block_next >= self._block_end:
+                return
+
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "UPDATE state SET value = ? WHERE key = 'next_row' AND value = ?",
+                    (str(self._block_next), str(self._block_end)),
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+            self._block_next = self._block_end = None
+            self._cache.pop("next_row", None)
+
+    def _allocate(self, n: int) -> int:
+        # The write lock is taken before reading so that the read and the
+        # update are atomic across processes
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self._conn.execute(
+                "SELECT value FROM state WHERE key = 'next_row'"
+            ).fetchone()
+            start = int(row[0]) if row else 2
+
+            self._conn.execute(
+                "INSERT OR REPLACE INTO state VALUES ('next_row', ?)", (str(start + n),)
+            )
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+
+        self._cache.pop("next_row", None)
+        return start
+
+    def migrate(self, path: str = "app_sheet.txt") -> None:
+        """
+        Imports the sheet details from the old app_sheet.txt file
+
+        ARGS:
+            path: Path of the old file
+
+        RETURNS:
+            None
+        """
+        if self.get("sheet_id") is not None or not os.path.exists(path):
+            return
+
+        with open(path, "r") as file:
+            lines = [line.strip() for line in file.readlines()]
+
+        if len(lines) < 3:
+            return
+
+        self.set("sheet_id", lines[0])
+        self.set("sheet_name", lines[1])
+        self.set("next_row", re.search(r"[A-Z]+(\d+)", lines[2]).group(1))
+
+    def close(self) -> None:
+        """
+        Releases the unused rows and closes the file
+
+        ARGS:
+            None
+
+        RETURNS:
+            None
+        """
+        self.release()
+        with self._lock:
+            self._conn.close()
@@ -1,92 +1,56 @@
 import re
-import os
-import os.path
 import pprint
-import base64
 import datetime
-import oauth2 as oauth
 import email
-import spacy
+import time
+import threading
 
 
-from apiclient import errors
-from email.mime.text import MIMEText
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
+from clients import get_service
+from mail_body import extract_text
+from metrics import metrics
+from nlp_service import get_nlp
+from ratelimit import get_limiter, is_retryable
+from sheet_index import SheetIndex
+from state import StateStore
 
-from apiclient import errors
-from email.mime.text import MIMEText
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from googleapiclient.errors import HttpError
-
-
-# If modifying these scopes, delete the file token.json.
-SCOPES = [
-    "https://www.googleapis.com/auth/gmail.modify",
-    "https://www.googleapis.com/auth/gmail.readonly",
-    "https://www.googleapis.com/auth/spreadsheets",
-]
-
-
-def get_service(service_type: str, version: str):
-    """
-    Returns the google api service object
-
-    ARGS:
-        type: type of service object (
-                gmail, sheets
-                )
-        version: version of the service object (
-                    v1 for gmail,
-                    v4 for sheets
-                    )
-
-    RETURNS:
-        googleapiclient.discovery.Resource: Google api service object
-    """
 
-    try:
-        if os.path.exists("token.json"):
-            creds = Credentials.from_authorized_user_file("token.json", SCOPES)
-        else:
-            creds = None
+# Maximum number of requests in a Gmail batch request
+BATCH_SIZE = 100
 
-        if not creds or not creds.valid:
-            if creds and creds.expired and creds.refresh_token:
-                creds.refresh(Request())
-            else:
-                flow = InstalledAppFlow.from_client_secrets_file(
-                    "credentials.json", SCOPES
-                )
-                creds = flow.run_local_server(port=0)
+# Maximum number of emails listed per page
+PAGE_SIZE = 500
 
-            with open("token.json", "w") as token:
-                token.write(creds.to_json())
+# Last column of the entries in the sheet
+LAST_COLUMN = "F"
 
-        service = build(service_type.strip(), version.strip(), credentials=creds)
-        return service
+# Headers fetched when only the metadata of the emails is needed
+METADATA_HEADERS = ["Subject", "From", "To", "Date"]
 
-    except Exception as e:
-        print(f"An error occured at get_service: {e}")
+# Maximum number of emails modified with one batchModify call
+MODIFY_BATCH_SIZE = 1000
 
 
 class GmailWorker:
-    def __init__(self):
+    def __init__(self, service=None):
         """
         Initializes GmailWorker Class by creating serive object for 
         gmail
 
         ARGS:
-            None
+            service: Gmail service object to use instead of building one
+                     (e.g. a local stand-in for the benchmarks)
 
         RETURNS:
             None
         """
-        self.service = get_service("gmail", "v1")
+        self.service = service or get_service("gmail", "v1")
+        self.limiter = get_limiter("gmail")
+
+        # Most recent history id of the mailbox seen while listing emails
+        self.history_id = None
 
     def get_messages(self, days: int, label: str = None, location: str = None) -> list:
         """
@@ -100,6 +64,20 @@ class GmailWorker:
         RETURNS:
             List of all the emails
         """
+        return list(self.iter_messages(days, label, location))
+
+    def iter_messages(self, days: int, label: str = None, location: str = None):
+        """
+        Yields all the relevant emails, page by page as they are listed
+
+        ARGS:
+            days: Number of days to far into
+            label: Possible label associated with emails
+            location: Location in the gmail where to look for
+
+        RETURNS:
+            Generator of the emails
+        """
         def generate_query(days: int, label: str, location: str) -> str:
             x_days_ago = (
                 datetime.datetime.now() - datetime.timedelta(days=days)
@@ -112,17 +90,146 @@ class GmailWorker:
                 query += f" in:{location.strip()}"
             return query
 
-        # Get the messages
-        results = (
-            self.service.users()
-            .messages()
-            .list(userId="me", q=generate_query(days, label, location))
-            .execute()
-        )
-        messages = results.get("messages", [])
-        if not messages:
+        query = generate_query(days, label, location)
+        page_token = None
+        found = False
+
+        # Get the messages, following every page
+        while True:
+            results = self.limiter.execute(
+                self.service.users()
+                .messages()
+                .list(
+                    userId="me",
+                    q=query,
+                    maxResults=PAGE_SIZE,
+                    pageToken=page_token,
+                )
+            )
+
+            for message in results.get("messages", []):
+                found = True
+                yield message
+
+            page_token = results.get("nextPageToken")
+            if not page_token:
+                break
+
+        if not found:
             print(f"No Emails found in the last {days} days.")
-        return messages
+
+    def get_history_id(self) -> str:
+        """
+        Returns the current history id of the mailbox
+
+        ARGS:
+            None
+
+        RETURNS:
+            The history id
+        """
+        profile = self.limiter.execute(self.service.users().getProfile(userId="me"))
+        return profile["historyId"]
+
+    def iter_new_messages(
+        self,
+        history_id: str,
+        days: int,
+        label: str = None,
+        location: str = None,
+    ):
+        """
+        Yields the emails added since the given history id, or all the
+        relevant emails of the last days when the history id is too old
+
+        The most recent history id is kept in self.history_id to be used by
+        the next run
+
+        ARGS:
+            history_id: History id of the previous run, if any
+            days: Number of days to look into when the history can't be used
+            label: Possible label associated with emails
+            location: Location in the gmail where to look for
+
+        RETURNS:
+            Generator of the emails
+        """
+        if history_id:
+            try:
+                yield from self.iter_history(history_id, label, location)
+                return
+            except HttpError as error:
+                # The history is only kept for a limited time
+                if error.resp.status != 404:
+                    raise
+                print("The mailbox history has expired, looking into the last days")
+
+        self.history_id = self.get_history_id()
+        yield from self.iter_messages(days, label, location)
+
+    def iter_history(self, history_id: str, label: str = None, location: str = None):
+        """
+        Yields the emails added since the given history id
+
+        ARGS:
+            history_id: History id to start from
+            label: Possible label associated with emails
+            location: Location in the gmail where to look for
+
+        RETURNS:
+            Generator of the emails
+        """
+        page_token = None
+        seen = set()
+
+        while True:
+            results = self.limiter.execute(
+                self.service.users()
+                .history()
+                .list(
+                    userId="me",
+                    startHistoryId=history_id,
+                    historyTypes=["messageAdded"],
+                    labelId=location.strip().upper() if location else None,
+                    maxResults=PAGE_SIZE,
+                    pageToken=page_token,
+                )
+            )
+
+            for record in results.get("history", []):
+                for added in record.get("messagesAdded", []):
+                    message = added["message"]
+                    labels = message.get("labelIds", [])
+                    if message["id"] in seen or (
+                        label and label.strip().upper() not in labels
+                    ):
+                        continue
+
+                    seen.add(message["id"])
+                    yield {"id": message["id"], "threadId": message.get("threadId")}
+
+            page_token = results.get("nextPageToken")
+            if not page_token:
+                self.history_id = results.get("historyId", history_id)
+                break
+
+    def watch(self, topic: str, label_ids: list = None) -> dict:
+        """
+        Asks Gmail to publish the changes of the mailbox to a Pub/Sub topic
+
+        ARGS:
+            topic: Full name of the Pub/Sub topic
+            label_ids: Labels to watch (all of them if not given)
+
+        RETURNS:
+            The history id and the expiration of the watch
+        """
+        body = {"topicName": topic}
+        if label_ids:
+            body["labelIds"] = label_ids
+            body["labelFilterBehavior"] = "INCLUDE"
+
+        return self.limiter.execute(self.service.users().watch(userId="me", body=body))
 
     def get_mail_details(self, msg: dict) -> dict:
         """
@@ -135,95 +242,216 @@ class GmailWorker:
             Details of the email (Subject, ID, Sender, Receiver, Date, Message)
         """
         # Call the Gmail API
-        txt = self.service.users().messages().get(userId="me", id=msg["id"]).execute()
-        payload = txt["payload"]
-        headers = payload["headers"]
+        with metrics.timer("gmail.fetch"):
+            txt = self.limiter.execute(
+                self.service.users().messages().get(userId="me", id=msg["id"])
+            )
+        return self.parse_mail(txt)
+
+    def get_mail_details_batch(self, msgs: list, prefilter=None) -> list:
+        """
+        Returns the details of many emails using batch requests
+
+        When a prefilter is given, only the headers of the emails are
+        fetched first and the full emails are fetched only for the ones
+        passing the prefilter
+
+        ARGS:
+            msgs: The emails
+            prefilter: Function that takes the details of an email without
+                       the message and returns True if the email should be
+                       fetched
+
+        RETURNS:
+            Details of the emails that could be read and passed the prefilter
+        """
+        ids = [msg["id"] for msg in msgs]
+
+        if prefilter:
+            headers = self.batch_get(
+                ids, format="metadata", metadataHeaders=METADATA_HEADERS
+            )
+            ids = [
+                msg_id
+                for msg_id in ids
+                if msg_id in headers
+                and prefilter(
+                    self.parse_headers(msg_id, headers[msg_id]["payload"]["headers"])
+                )
+            ]
+
+        txts = self.batch_get(ids)
+
+        mails = []
+        for msg_id in ids:
+            details = self.parse_mail(txts[msg_id]) if msg_id in txts else None
+            if details:
+                mails.append(details)
+            else:
+                print(f"This email couldn't be read: {msg_id}\n")
+        return mails
+
+    def batch_get(self, ids: list, **kwargs) -> dict:
+        """
+        Gets the emails with batch requests of up to BATCH_SIZE emails
+
+        ARGS:
+            ids: Ids of the emails
+            kwargs: Additional parameters of messages().get
+
+        RETURNS:
+            The emails that could be fetched by their id
+        """
+        txts = {}
+        pending = list(ids)
+        attempt = 0
+
+        while pending:
+            failed = []
+
+            def callback(request_id, response, exception):
+                if exception is None:
+                    txts[request_id] = response
+                elif is_retryable(exception) and attempt < self.limiter.retries:
+                    failed.append((request_id, exception))
+                else:
+                    print(f"An error occurred while getting the email {request_id}: {exception}")
+
+            for i in range(0, len(pending), BATCH_SIZE):
+                chunk = pending[i : i + BATCH_SIZE]
+                batch = self.service.new_batch_http_request(callback=callback)
+                for msg_id in chunk:
+                    batch.add(
+                        self.service.users().messages().get(userId="me", id=msg_id, **kwargs),
+                        request_id=msg_id,
+                    )
+                with metrics.timer("gmail.fetch_batch"):
+                    self.limiter.execute(batch, cost=len(chunk))
+
+            if not failed:
+                break
+
+            # Retry the emails that hit a temporary error
+            self.limiter.failure(failed[0][1])
+            time.sleep(self.limiter.backoff(attempt))
+            attempt += 1
+            pending = [msg_id for msg_id, _ in failed]
+
+        return txts
+
+    def parse_headers(self, msg_id: str, headers: list) -> dict:
+        """
+        Returns the details of the email from its headers
+
+        ARGS:
+            msg_id: Id of the email
+            headers: Headers of the email
+
+        RETURNS:
+            Details of the email (Subject, ID, Sender, Receiver, Date)
+        """
+        details = {
+            "subject": "",
+            "id": msg_id,
+            "sender": "",
+            "receiver": "",
+            "date": "",
+        }
 
         # Grab the Subject Line, From and Date from the Email
         for d in headers:
             if d["name"] == "Subject":
-                subject = d["value"]
+                details["subject"] = d["value"]
             if d["name"] == "To":
-                receiver = d["value"]
+                details["receiver"] = d["value"]
             if d["name"] == "From":
-                sender = d["value"]
-                try:
-                    match = re.search(r"<(.*)>", sender).group(1)
-                except:
-                    match = sender
+                details["sender"] = d["value"]
             if d["name"] == "Date":
-                date = d["value"][:31]
-                
-        def get_body(payload: dict) -> str:
-            if "body" in payload and "data" in payload["body"]:
-                return payload["body"]["data"]
-            elif "parts" in payload:
-                for part in payload["parts"]:
-                    data = get_body(part)
-                    if data:
-                        return data
-            else:
-                return None
+                details["date"] = d["value"][:31]
 
-        data = get_body(payload)
+        return details
 
-        if data:
-            data = data.replace("-", "+").replace("_", "/")
-            decoded_data = base64.b64decode(data).decode("UTF-8")
-            decoded_data = (decoded_data.encode("ascii", "ignore")).decode("UTF-8")
-            decoded_data = (
-                decoded_data.replace("\n", "").replace("\r", "").replace("\t", "")
-            )
+    def parse_mail(self, txt: dict) -> dict:
+        """
+        Parses the email returned by the Gmail API
+
+        ARGS:
+            txt: The email (in the full format)
+
+        RETURNS:
+            Details of the email (Subject, ID, Sender, Receiver, Date, Message)
+        """
+        payload = txt["payload"]
+        details = self.parse_headers(txt["id"], payload["headers"])
 
-            print(len(date))
+        with metrics.timer("gmail.decode"):
+            message = extract_text(payload)
 
-            return {
-                "subject": subject,
-                "id": msg["id"],
-                "sender": sender,
-                "receiver": receiver,
-                "date": date,
-                "message": decoded_data,
-            }
+        if not message:
+            return None
 
-        return None
+        details["message"] = message
+        return details
 
-    def mark_read(self, message_id: str) -> None:
+    def mark_read(self, message_ids: list) -> list:
         """
-        Marks the email as read
+        Marks the emails as read with batchModify calls of up to
+        MODIFY_BATCH_SIZE emails
 
         ARGS:
-            message_id: id of the email
+            message_ids: ids of the emails
 
         RETURNS:
-            None
+            The ids of the emails that couldn't be marked read
         """
+        failed = []
 
-        try:
-            message = (
-                self.service.users()
-                .messages()
-                .modify(userId="me", id=message_id, body={"removeLabelIds": ["UNREAD"]})
-                .execute()
-            )
+        for i in range(0, len(message_ids), MODIFY_BATCH_SIZE):
+            chunk = message_ids[i : i + MODIFY_BATCH_SIZE]
+            try:
+                with metrics.timer("gmail.mark_read"):
+                    self.limiter.execute(
+                        self.service.users()
+                        .messages()
+                        .batchModify(
+                            userId="me",
+                            body={"ids": chunk, "removeLabelIds": ["UNREAD"]},
+                        )
+                    )
 
-        except Exception as e:
-            print(f"An error occurred while marking the email {message_id} read: {e}")
+            except Exception as e:
+                print(f"An error occurred while marking {len(chunk)} emails read: {e}")
+                failed.extend(chunk)
+
+        return failed
 
 
 class SheetsWorker:
-    def __init__(self):
+    def __init__(self, service=None):
         """
         Initializes the SheetsWorker class by creating a google service object for google sheets
 
         ARGS:
-            None
+            service: Sheets service object to use instead of building one
+                     (e.g. a local stand-in for the benchmarks)
 
         RETURNS:
             None
         """
-        self.service = get_service("sheets", "v4")
-        self.nlp = spacy.load("en_core_web_lg")
+        self.service = service or get_service("sheets", "v4")
+        self.limiter = get_limiter("sheets")
+
+        # Sheet details and next free row
+        self.state = StateStore()
+        self.state.migrate()
+
+        # Index of the rows of the sheet, loaded once when first needed
+        self.index = None
+        self._index_lock = threading.Lock()
+
+    @property
+    def nlp(self):
+        return get_nlp()
 
     def create_sheet(self, title: str) -> None:
         """
@@ -242,10 +470,9 @@ class SheetsWorker:
         ):
             try:
                 spreadsheet = {"properties": {"title": title}}
-                spreadsheet = (
+                spreadsheet = self.limiter.execute(
                     self.service.spreadsheets()
                     .create(body=spreadsheet, fields="spreadsheetId")
-                    .execute()
                 )
                 print(f"Spreadsheet ID: {(spreadsheet.get('spreadsheetId'))}")
 
@@ -256,10 +483,9 @@ class SheetsWorker:
                     ["Company", "Role", "Date", "Notes", "Most Recent Email", "Status"],
                 )
 
-                with open("app_sheet.txt", "w") as sheet:
-                    sheet.write(
-                        f'{spreadsheet.get("spreadsheetId")}\n{title}\n{"A2:F2"}'
-                    )
+                self.state.set("sheet_id", spreadsheet.get("spreadsheetId"))
+                self.state.set("sheet_name", title)
+                self.state.set("next_row", 2)
 
             except HttpError as error:
                 print(f"An error occurred at create_sheet: {error}")
@@ -274,90 +500,114 @@ class SheetsWorker:
             None
 
         RETURNS:
-            Details of the google sheets
+            Details of the google sheets (id and name)
         """
 
-        if os.path.exists("app_sheet.txt"):
-            with open("app_sheet.txt", "r") as file:
-                details = file.readlines()
-                return details
-        return None
+        sheet_id = self.state.get("sheet_id")
+        if sheet_id is None:
+            return None
+        return [sheet_id, self.state.get("sheet_name", "")]
 
-    def update_sheet_details(self, n: int) -> None:
+    def reserve_range(self) -> str:
         """
-        Updates the application sheet detail file (app_sheet.txt)
+        Reserves the range of a new entry in the sheet
 
         ARGS:
-            n: The number of new columns added in the sheets
+            None
 
         RETURNS:
-            None
+            The range of the new entry
         """
 
-        with open("app_sheet.txt", "r+") as file:
-            lines = file.readlines()
-            file.seek(0)
+        row = self.state.reserve_row()
+        return f"A{row}:{LAST_COLUMN}{row}"
 
-            for line in lines:
-                if ":" in line:
-                    col_start, col_end = line[0], line[-2]
+    def load_index(self, spreadsheet_id: str) -> SheetIndex:
+        """
+        Loads the company, role and date of every row of the sheet in the
+        index, only the first time it is called
 
-                    row1 = str(int(line[1]) + n)
-                    row2 = str(int(line[-1]) + n)
-                    line = f"{col_start}{row1}:{col_end}{row2}"
+        ARGS:
+            spreadsheet_id: Id of the google sheet
 
-                file.write(line)
+        RETURNS:
+            The index of the sheet
+        """
+        with self._index_lock:
+            if self.index is None:
+                with metrics.timer("sheets.read"):
+                    result = self.limiter.execute(
+                        self.service.spreadsheets()
+                        .values()
+                        .get(spreadsheetId=spreadsheet_id, range="A2:C")
+                    )
+                index = SheetIndex(self.nlp)
+                index.load(result.get("values", []))
+                self.index = index
+            return self.index
 
     def get_existing_range(self, company: str, role: str) -> str:
         """
         Returns the existing range for given values
 
         ARGS:
-            company: id of the email
+            company: Name of the company
+            role: Name of the role
 
         RETURNS:
             Range for the values
         """
 
-        # call the sheets api
         try:
             sheet_details = self.get_sheet_details()
-            range_end = str(int(sheet_details[2][-1]) - 1)
+            index = self.load_index(sheet_details[0].strip())
 
-            range_names = [f"A2:B{range_end}"]
-
-            result = (
-                self.service.spreadsheets()
-                .values()
-                .batchGet(spreadsheetId=sheet_details[0].strip(), ranges=range_names)
-                .execute()
-            )
-            ranges = result.get("valueRanges", [])
-            values = ranges[0]["values"]
-
-            rows = len(values)
-            cols = len(values[0])
-            for r in range(rows):
-                for c in range(0, cols, 2):
-                    if (
-                        values[r][c].lower().strip() == company.lower().strip()
-                        and self.nlp(values[r][c + 1].lower().strip()).similarity(
-                            self.nlp(role.lower().strip())
-                        )
-                        > 0.8
-                    ):
-                        row = r + 2
-                        col_end = sheet_details[-1][-2]
-                        range_val = f"A{row}:{col_end}{row}"
+            with metrics.timer("sheets.range_lookup"):
+                row = index.find(company, role)
+            if row is None:
+                return None
 
-                        return range_val 
-            return None
+            return f"A{row}:{LAST_COLUMN}{row}"
 
         # except HttpError as error:
         except Exception as e:
             print(f"An error occured at get_existing_range: {e}")
             pass
 
+    def add_to_index(self, company: str, role: str, range_name: str) -> None:
+        """
+        Adds a new entry of the sheet to the index
+
+        ARGS:
+            company: Name of the company
+            role: Name of the role
+            range_name: Range of the new entry
+
+        RETURNS:
+            None
+        """
+        if self.index is not None:
+            row = int(re.search(r"\d+", range_name).group(0))
+            self.index.add(company, role, row)
+
+    def claim_range(self, range_name: str, date: str) -> bool:
+        """
+        Checks in the index that the email is more recent than the one
+        written to the range, and records it as the most recent one
+
+        ARGS:
+            range_name: Range of the entry
+            date: Date of the email
+
+        RETURNS:
+            True if the range should be updated with the email
+        """
+        if self.index is None:
+            return True
+
+        row = int(re.search(r"\d+", range_name).group(0))
+        return self.index.claim(row, date)
+
     def update_sheet(
         self,
         spreadsheet_id: str,
@@ -380,22 +630,55 @@ class SheetsWorker:
         try:
             values = [val]
             body = {"values": values}
-            result = (
-                self.service.spreadsheets()
-                .values()
-                .update(
-                    spreadsheetId=spreadsheet_id,
-                    range=range_name,
-                    valueInputOption=value_input_option,
-                    body=body,
+            with metrics.timer("sheets.write"):
+                result = self.limiter.execute(
+                    self.service.spreadsheets()
+                    .values()
+                    .update(
+                        spreadsheetId=spreadsheet_id,
+                        range=range_name,
+                        valueInputOption=value_input_option,
+                        body=body,
+                    )
                 )
-                .execute()
-            )
             return result
         except HttpError as error:
             print(f"An error occurred at update_sheet: {error}")
             return error
 
+    def batch_update(
+        self,
+        spreadsheet_id: str,
+        data: list,
+        value_input_option: str,
+    ) -> dict:
+        """
+        Updates many ranges of the sheet with one request
+
+        ARGS:
+            spreadsheet_id: id of the google sheet
+            data: the ranges and the values to update them with
+            value_input_option: input value for data interpretation
+
+        RETURNS:
+            The result of the request
+        """
+
+        try:
+            body = {"valueInputOption": value_input_option, "data": data}
+            with metrics.timer("sheets.write"):
+                result = self.limiter.execute(
+                    self.service.spreadsheets()
+                    .values()
+                    .batchUpdate(spreadsheetId=spreadsheet_id, body=body)
+                )
+            return result
+        # Network errors are raised by the limiter once it stops retrying,
+        # the caller keeps the updates for the next write
+        except Exception as error:
+            print(f"An error occurred at batch_update: {error}")
+            return error
+
     def get_values(self, range_name: str, spreadsheet_id: str) -> list:
         """
         Returns the values in the given range
@@ -408,14 +691,12 @@ class SheetsWorker:
         """
 
         try:
-            result = (
-                self.service.spreadsheets()
-                .values()
-                .get(spreadsheetId=spreadsheet_id, range=range_name)
-                .execute()
-            )
-            rows = result.get("values", [])
-            print(f"{len(rows)} rows retrieved")
+            with metrics.timer("sheets.read"):
+                result = self.limiter.execute(
+                    self.service.spreadsheets()
+                    .values()
+                    .get(spreadsheetId=spreadsheet_id, range=range_name)
+                )
             return result
         except HttpError as error:
             print(f"An error occurred at get_values: {error}")